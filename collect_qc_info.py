@@ -16,12 +16,690 @@
 
 ### ........ IMPORT MODULES ........###
 
+import hashlib
+import io
+import json
 import os
 import sys
 import re
+import time
+import socket
+import tempfile
 import argparse
+import mimetypes
+import threading
+import multiprocessing
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
 from zipfile import ZipFile
-from shutil import copyfile
+from shutil import copy2, copyfileobj, copystat, rmtree
+import qc_warehouse
+import compressed_io
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+### ........ DEFINE FUNCTIONS ........###
+
+FICLONE = 0x40049409    # Linux ioctl to reflink one file to another
+MAX_OPEN_ZIPS = 64      # fastqc.zip files the report server (--serve) keeps open
+MODULES_MARKER = '.fastqc_modules'      # marks a --modules directory as written (and replaceable) by write_module_arrays
+
+openZips = OrderedDict()
+openZipsLock = threading.Lock()
+
+def lib_files(projectIndex, libID):
+    # The index entry for one library, created empty the first time the library is seen
+    if libID not in projectIndex:
+        projectIndex[libID] = {'zips': [], 'reports': [], 'align': [], 'counts': []}
+    return projectIndex[libID]
+
+def scan_project(projectDir):
+    # Walk the project tree once with os.scandir and index, by library ID, every file the
+    # later steps read: fastqc zips, extracted *_fastqc report directories,
+    # hisat_out/align_summary.txt and rawcounts_output/countRunsummary.txt.
+    # Nothing below a report, hisat_out, rawcounts_output or stringtie_out directory is listed
+    projectIndex = {}
+    toScan = [projectDir]
+    while toScan:
+        direc = toScan.pop()
+        try:
+            with os.scandir(direc) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name.endswith('fastqc'):
+                    lib_files(projectIndex, entry.name.split('_')[0])['reports'].append(entry.path)
+                elif entry.name == 'hisat_out':
+                    lib_files(projectIndex, os.path.basename(direc).split('_')[0])['align'].append(os.path.join(entry.path, 'align_summary.txt'))
+                elif entry.name == 'rawcounts_output':
+                    lib_files(projectIndex, os.path.basename(direc).split('_')[0])['counts'].append(os.path.join(entry.path, 'countRunsummary.txt'))
+                elif entry.name != 'stringtie_out' and not entry.is_symlink():
+                    toScan.append(entry.path)
+            elif entry.name.endswith('fastqc.zip'):
+                lib_files(projectIndex, entry.name.split('_')[0])['zips'].append(entry.path)
+    return projectIndex
+
+def sample_name(filename):
+    # Name a sample by library ID, read and trim status (e.g. 1234_R1_trimmed),
+    # from the fastq file name recorded in the FastQC report
+    libNum = filename.split('_')[0]
+    sample = libNum
+    if re.match(r'^\d{3,4}_S.{1,14}_val_1', filename):
+        sample = (libNum + "_R1_trimmed")
+    if re.match(r'^\d{3,4}_S.{1,14}_val_2', filename):
+        sample = (libNum + "_R2_trimmed")
+    if re.match(r'^\d{3,4}_S.{1,7}_R1_001.f', filename):
+        sample = (libNum + "_R1_untrimmed")
+    if re.match(r'^\d{3,4}_S.{1,7}_R2_001.f', filename):
+        sample = (libNum + "_R2_untrimmed")
+    return sample
+
+def report_name(reportPath):
+    # The *_fastqc name of a report, given its extracted directory or its *fastqc.zip
+    reportName = os.path.basename(reportPath)
+    if reportName.endswith('.zip'):
+        reportName = reportName[:-4]
+    return reportName
+
+def report_member(zip, fileName):
+    # Find a file in the top-level *_fastqc directory of a FastQC archive
+    for member in zip.namelist():
+        if member.count('/') == 1 and member.endswith('/' + fileName):
+            return member
+    raise KeyError(fileName + " not found in " + str(zip.filename))
+
+def report_url(reportPath):
+    # Location of fastqc_report.html (for a zipped report, the member inside the archive)
+    if reportPath.endswith('.zip'):
+        return os.path.join(reportPath, report_name(reportPath), 'fastqc_report.html')
+    return os.path.join(reportPath, 'fastqc_report.html')
+
+def read_fastqc_report(reportPath):
+    # Return the lines of summary.txt and fastqc_data.txt for one report.
+    # A *fastqc.zip is read in place, decompressing only those two members
+    if reportPath.endswith('.zip'):
+        with ZipFile(reportPath, 'r') as zip:
+            with zip.open(report_member(zip, 'summary.txt')) as summaryFile:
+                summaryLines = io.TextIOWrapper(summaryFile).readlines()
+            with zip.open(report_member(zip, 'fastqc_data.txt')) as dataFile:
+                dataLines = io.TextIOWrapper(dataFile).readlines()
+    else:
+        with open(os.path.join(reportPath, 'summary.txt'), 'r') as summaryFile:
+            summaryLines = summaryFile.readlines()
+        with open(os.path.join(reportPath, 'fastqc_data.txt'), 'r') as dataFile:
+            dataLines = dataFile.readlines()
+    return summaryLines, dataLines
+
+def report_date(reportPath):
+    # The day FastQC wrote a report: the time stamp of fastqc_data.txt in its fastqc.zip, whether
+    # or not the zip was extracted (extractall gives the extracted files the time of extraction).
+    # An extracted report without its zip falls back to the mtime of fastqc_data.txt
+    zipPath = reportPath if reportPath.endswith('.zip') else reportPath + '.zip'
+    if os.path.exists(zipPath):
+        with ZipFile(zipPath, 'r') as zip:
+            return '%04d-%02d-%02d' % zip.getinfo(report_member(zip, 'fastqc_data.txt')).date_time[:3]
+    return time.strftime('%Y-%m-%d', time.localtime(os.path.getmtime(os.path.join(reportPath, 'fastqc_data.txt'))))
+
+def link_or_copy(src, dst):
+    # Put src at dst without copying data where possible: a hard link if both are on the same
+    # filesystem, else a copy-on-write reflink (btrfs, XFS), else a real copy. Returns which was done
+    try:
+        os.link(src, dst)
+        return 'linked'
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as srcFile, open(dst, 'wb') as dstFile:
+                fcntl.ioctl(dstFile.fileno(), FICLONE, srcFile.fileno())
+            copystat(src, dst)
+            return 'reflinked'
+        except OSError:
+            pass
+    copy2(src, dst)
+    return 'copied'
+
+def publish_html(reportPath, dst):
+    # Publish fastqc_report.html from an extracted report, or straight out of the archive, to dst.
+    # Skipped if dst already has the source's size and mtime (or is a hard link to it).
+    # Returns 'unchanged', 'linked', 'reflinked' or 'copied'
+    if reportPath.endswith('.zip'):
+        # A copy out of the archive has the member's size and the archive's mtime
+        zipStat = os.stat(reportPath)
+        with ZipFile(reportPath, 'r') as zip:
+            member = zip.getinfo(report_member(zip, 'fastqc_report.html'))
+            if os.path.exists(dst):
+                dstStat = os.stat(dst)
+                if (dstStat.st_size, dstStat.st_mtime_ns) == (member.file_size, zipStat.st_mtime_ns):
+                    return 'unchanged'
+            with zip.open(member) as src, open(dst + '.tmp', 'wb') as out:
+                copyfileobj(src, out)
+        os.replace(dst + '.tmp', dst)
+        os.utime(dst, ns=(zipStat.st_atime_ns, zipStat.st_mtime_ns))
+        return 'copied'
+    src = os.path.join(reportPath, 'fastqc_report.html')
+    if os.path.exists(dst):
+        srcStat = os.stat(src)
+        dstStat = os.stat(dst)
+        if os.path.samestat(srcStat, dstStat):
+            return 'unchanged'
+        if (srcStat.st_size, srcStat.st_mtime_ns) == (dstStat.st_size, dstStat.st_mtime_ns):
+            return 'unchanged'
+        os.remove(dst)
+    return link_or_copy(src, dst)
+
+def extract_report(zipPath):
+    # Unzip one fastqc.zip into its own directory and return the extracted *_fastqc directory
+    #print("UNZIPPING " + zipPath + ' into the same directory ...')
+    zipDirec = zipPath.rsplit('/', 1)[0]
+    with ZipFile(zipPath, 'r') as zip:
+        zip.extractall(zipDirec)
+    return os.path.join(zipDirec, report_name(zipPath))
+
+def summary_row(parsedReport, url2):
+    # One line of fastQC_summary.tsv: the sample, PASS/WARN/FAIL for each module,
+    # the report URL and the total number of sequences
+    return parsedReport['summary'] + url2 + "\t" + parsedReport['totalSeq']
+
+def or_rows(dataLines):
+    # Lines of OR_Sequences.tsv: each row of the Overrepresented sequences module, tagged with the sample
+    filename = dataLines[3].split('\t')[1]
+    sample = sample_name(filename)
+    rows = []
+    inRecordingMode = False
+    for line in dataLines[4:]:
+        if not inRecordingMode:
+            if line.startswith('#Sequence'):
+                inRecordingMode = True
+        elif line.startswith('>>END_MODULE'):
+            inRecordingMode = False
+        else:
+            rows.append(sample + "\t" + line)
+    return rows
+
+def or_catalog(orRows):
+    # Deduplicate overrepresented sequences across all samples in one pass over the
+    # OR_Sequences.tsv rows, keyed on the sequence. Returns (sequence, entry) pairs, most widespread
+    # first, where entry counts the samples and libraries containing the sequence, its summed
+    # count, summed and max percentage, and the first source FastQC suggested for it
+    catalog = {}
+    for line in orRows:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 4:
+            continue
+        sample, sequence, count, percentage = fields[:4]
+        source = fields[4] if len(fields) > 4 else 'No Hit'
+        entry = catalog.get(sequence)
+        if entry is None:
+            entry = {'samples': set(), 'libraries': set(), 'count': 0, 'sumPercentage': 0.0, 'maxPercentage': 0.0, 'source': source}
+            catalog[sequence] = entry
+        entry['samples'].add(sample)
+        entry['libraries'].add(sample.split('_')[0])
+        entry['count'] += int(count)
+        entry['sumPercentage'] += float(percentage)
+        entry['maxPercentage'] = max(entry['maxPercentage'], float(percentage))
+        if entry['source'] == 'No Hit':
+            entry['source'] = source
+    return sorted(catalog.items(), key=lambda item: (-len(item[1]['samples']), -item[1]['sumPercentage'], item[0]))
+
+def read_fasta(fastaPath):
+    # (name, sequence) pairs from a FASTA file; the name is the whole header line
+    references = []
+    with open(fastaPath, 'r') as fastaFile:
+        for line in fastaFile:
+            line = line.strip()
+            if line.startswith('>'):
+                references.append([line[1:].strip(), []])
+            elif line and references:
+                references[-1][1].append(line.upper())
+    return [(name, ''.join(sequence)) for name, sequence in references]
+
+def reverse_complement(sequence):
+    return sequence.translate(str.maketrans('ACGTN', 'TGCAN'))[::-1]
+
+def kmer_index(references, k):
+    # Map every k-mer of each reference sequence, and of its reverse complement,
+    # to the indices of the references that contain it
+    kmerIndex = {}
+    for n, (name, sequence) in enumerate(references):
+        for strand in (sequence, reverse_complement(sequence)):
+            for i in range(len(strand) - k + 1):
+                kmerIndex.setdefault(strand[i:i + k], set()).add(n)
+    return kmerIndex
+
+def classify_sequence(sequence, references, kmerIndex, k):
+    # The reference sharing the most k-mers with sequence, as "name (shared/total k-mers)", or 'No Hit'
+    hits = {}
+    kmers = set(sequence[i:i + k] for i in range(len(sequence) - k + 1))
+    for kmer in kmers:
+        for n in kmerIndex.get(kmer, ()):
+            hits[n] = hits.get(n, 0) + 1
+    if not hits:
+        return 'No Hit'
+    best = max(hits, key=lambda n: (hits[n], -n))
+    return references[best][0] + ' (' + str(hits[best]) + '/' + str(len(kmers)) + ' k-mers)'
+
+def parse_fastqc_modules(dataLines):
+    # Split fastqc_data.txt into its >>Module ... >>END_MODULE blocks, as
+    # {module: {'status': pass/warn/fail, 'values': {name: value}, 'header': [columns], 'rows': [[fields]]}}
+    # The last '#' line before a module's rows is its header; earlier ones
+    # (e.g. #Total Deduplicated Percentage) are single name/value pairs
+    modules = {}
+    module = None
+    for line in dataLines:
+        line = line.rstrip('\n')
+        if line.startswith('>>END_MODULE'):
+            module = None
+        elif line.startswith('>>'):
+            fields = line[2:].split('\t')
+            module = {'status': fields[1] if len(fields) > 1 else '', 'values': {}, 'header': [], 'rows': []}
+            modules[fields[0]] = module
+        elif module is None or line == '':
+            continue
+        elif line.startswith('#'):
+            if len(module['header']) == 2 and not module['rows']:
+                module['values'][module['header'][0]] = module['header'][1]
+            module['header'] = line[1:].split('\t')
+        else:
+            module['rows'].append(line.split('\t'))
+    return modules
+
+def parse_report(reportPath, parseModules=False):
+    # Everything the outputs need from one report, in the form kept in the cache:
+    # the sample and module results (summary.txt), the total number of sequences
+    # (line 6 of fastqc_data.txt), the overrepresented sequence rows and,
+    # if parseModules, every module of fastqc_data.txt
+    summaryLines, dataLines = read_fastqc_report(reportPath)
+    summary = ""
+    for i, line in enumerate(summaryLines):
+        if i == 0:
+            filename = line.split('\t')[2]
+            summary += sample_name(filename) + " \t"
+        result = line.split('\t')[0]
+        summary += result + "\t"
+    totalSeq = dataLines[6].split('\t')[1]
+    parsedReport = {'summary': summary, 'totalSeq': totalSeq, 'OR': or_rows(dataLines)}
+    if parseModules:
+        parsedReport['modules'] = parse_fastqc_modules(dataLines)
+    return parsedReport
+
+def publish_report(reportPath, htmlDirec):
+    # Publish a report's fastqc_report.html to its own folder in htmlDirec ('n' = leave the report
+    # where it is). Returns its URL and what publish_html() did
+    reportName = report_name(reportPath)
+    if htmlDirec == "n":
+        #print("not moving html files")
+        return report_url(reportPath), 'unchanged'
+    newDirec = os.path.join(htmlDirec, reportName)
+    #print(newDirec + " is the directory to create")
+    dst = os.path.join(htmlDirec, reportName, 'fastqc_report.html')
+    #print(dst + " is the destination")
+    url2 = os.path.join(htmlDirec, reportName, 'fastqc_report.html')
+    # UNCOMMENT IF USING RAVEN:
+    #url2 = os.path.join('http://raven.anr.udel.edu/fastqc_reports', reportName, 'fastqc_report.html')
+    try:
+        os.mkdir(newDirec)
+    except OSError:
+        #print ("Creation of the directory failed" + newDirec)
+        pass
+    else:
+        print ("Successfully created the directory " + newDirec)
+    return url2, publish_html(reportPath, dst)
+
+def alignment_stats(statsPath):
+    # The alignmentStats.tsv fields from one hisat2 align_summary.txt (reads, overall alignment rate)
+    # or featurecounts countRunsummary.txt (total, successfully assigned)
+    fileName = statsPath.rsplit("/", 3)[1]
+    basename = fileName.split("_")[0]
+    stats = ""
+    with open(statsPath) as inFile:
+        for i, line in enumerate(inFile):
+            if re.search("reads", line):
+                reads = line.split(" ")[0]
+            if re.search("overall", line):
+                alignPercent = line.split(" ")[0]
+                stats += basename + '\t' + reads + '\t' + alignPercent + '\t'
+            if re.search("Total", line):
+                total = (line.split(" ")[7])
+            if re.search("Successfully", line):
+                percent=(line.split(" ")[9])
+                stats += basename + '\t' + total + '\t' + percent + '\n'
+    return stats
+
+def array_name(name):
+    # Module and column names as array file names, e.g. "Per base sequence quality" -> Per_base_sequence_quality
+    return re.sub('[^0-9A-Za-z]+', '_', name).strip('_')
+
+def column_array(values):
+    # A typed array for one column: int64 or float64 when every value is a number
+    # (missing values, None, become NaN), otherwise strings (missing become '')
+    if None not in values:
+        try:
+            return np.array([int(v) for v in values], dtype=np.int64)
+        except ValueError:
+            pass
+    try:
+        return np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)
+    except ValueError:
+        return np.array(['' if v is None else v for v in values], dtype=str)
+
+def write_module_arrays(samples, reportPaths, moduleList, modulesPath):
+    # Save the fastqc_data.txt modules of every report (moduleList, in sample order) as a directory
+    # of typed column .npy files, each readable with np.load(path, mmap_mode='r') (an .npz cannot be
+    # memory-mapped): samples.npy, reports.npy and, for each module:
+    #   <module>/status.npy        pass/warn/fail per sample ('' if the report has no such module)
+    #   <module>/offsets.npy       the rows of sample i are offsets[i]:offsets[i + 1]
+    #   <module>/<column>.npy      every sample's rows of that column, one after another
+    #   <module>/<name>.npy        per-sample values from '#name<tab>value' lines
+    arrays = {'samples': np.array(samples, dtype=str), 'reports': np.array(reportPaths, dtype=str)}
+    moduleNames = []
+    for modules in moduleList:
+        for moduleName in modules:
+            if moduleName not in moduleNames:
+                moduleNames.append(moduleName)
+    for moduleName in moduleNames:
+        key = array_name(moduleName)
+        status = []
+        offsets = [0]
+        header = []
+        valueNames = []
+        for modules in moduleList:
+            module = modules.get(moduleName, {'status': '', 'values': {}, 'header': [], 'rows': []})
+            status.append(module['status'])
+            offsets.append(offsets[-1] + len(module['rows']))
+            header += [column for column in module['header'] if column not in header]
+            valueNames += [name for name in module['values'] if name not in valueNames]
+        arrays[key + '/status'] = np.array(status, dtype=str)
+        arrays[key + '/offsets'] = np.array(offsets, dtype=np.int64)
+        for column in header:
+            values = []
+            for modules in moduleList:
+                module = modules.get(moduleName)
+                if module is None:
+                    continue
+                if column in module['header']:
+                    position = module['header'].index(column)
+                    values += [row[position] if position < len(row) else None for row in module['rows']]
+                else:
+                    values += [None] * len(module['rows'])
+            arrays[key + '/' + array_name(column)] = column_array(values)
+        for name in valueNames:
+            arrays[key + '/' + array_name(name)] = column_array([modules.get(moduleName, {'values': {}})['values'].get(name) for modules in moduleList])
+    # Written to a new directory beside modulesPath, which then replaces modulesPath only if it is
+    # empty or was written here before (see modules_path_problem)
+    if modules_path_problem(modulesPath):
+        raise OSError(modulesPath + " " + modules_path_problem(modulesPath))
+    modulesPath = os.path.normpath(modulesPath)
+    tmpPath = tempfile.mkdtemp(prefix='.' + os.path.basename(modulesPath) + '.', dir=os.path.dirname(os.path.abspath(modulesPath)))
+    try:
+        for key, array in arrays.items():
+            os.makedirs(os.path.dirname(os.path.join(tmpPath, key + '.npy')), exist_ok=True)
+            np.save(os.path.join(tmpPath, key + '.npy'), array)
+        open(os.path.join(tmpPath, MODULES_MARKER), 'w').close()
+        if os.path.isdir(modulesPath) and os.listdir(modulesPath):
+            rmtree(modulesPath)
+        elif os.path.isdir(modulesPath):
+            os.rmdir(modulesPath)
+        os.replace(tmpPath, modulesPath)
+    except BaseException:
+        rmtree(tmpPath, ignore_errors=True)
+        raise
+
+def modules_path_problem(modulesPath):
+    # Why --modules cannot write to modulesPath, or None: it must be new, an empty directory, or
+    # a directory written by write_module_arrays (it has the MODULES_MARKER file), as it is replaced
+    if not os.path.exists(modulesPath):
+        return None
+    if not os.path.isdir(modulesPath):
+        return "exists and is not a directory"
+    if os.path.realpath(modulesPath) == os.path.realpath(os.getcwd()):
+        return "is the working directory"
+    if os.listdir(modulesPath) and not os.path.exists(os.path.join(modulesPath, MODULES_MARKER)):
+        return "is a directory not written by --modules; give a new or empty directory"
+    return None
+
+def position_start(position):
+    # Sort key for FastQC base positions, which are single bases ('7') or bins ('10-14')
+    try:
+        return int(position.split('-')[0])
+    except ValueError:
+        return 0
+
+def quality_matrix(moduleList, column):
+    # Libraries x positions matrix of one Per base sequence quality column (e.g. Mean, Lower Quartile).
+    # Columns are every base/bin seen in any library, in base order; NaN where a library has no such position
+    positions = []
+    for modules in moduleList:
+        for row in modules.get('Per base sequence quality', {'rows': []})['rows']:
+            if row[0] not in positions:
+                positions.append(row[0])
+    positions = sorted(positions, key=position_start)
+    positionIndex = {position: j for j, position in enumerate(positions)}
+    matrix = np.full((len(moduleList), len(positions)), np.nan)
+    for i, modules in enumerate(moduleList):
+        module = modules.get('Per base sequence quality')
+        if module is None or column not in module['header']:
+            continue
+        k = module['header'].index(column)
+        for row in module['rows']:
+            matrix[i, positionIndex[row[0]]] = float(row[k])
+    return matrix
+
+def robust_z(matrix):
+    # Robust z-scores down each column, (x - median) / (1.4826 * MAD).
+    # NaN where the column has no spread, so a constant position never flags anyone
+    median = np.nanmedian(matrix, axis=0)
+    mad = 1.4826 * np.nanmedian(np.abs(matrix - median), axis=0)
+    mad[mad == 0] = np.nan
+    return (matrix - median) / mad
+
+def quality_outliers(samples, moduleList, threshold):
+    # Flag libraries whose per-base quality is low relative to the other libraries of the same
+    # read and trim status (R1/R2, trimmed/untrimmed). For each group, libraries x positions
+    # matrices of mean and lower-quartile quality are scored with robust z-scores per position;
+    # a library's score is its median z over positions. The worst tile (lowest Per tile sequence
+    # quality deviation) is scored the same way. Returns one row of fields per sample
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        meanQual = quality_matrix(moduleList, 'Mean')
+        lowerQual = quality_matrix(moduleList, 'Lower Quartile')
+        worstTile = np.full((len(moduleList), 1), np.nan)
+        for i, modules in enumerate(moduleList):
+            module = modules.get('Per tile sequence quality')
+            if module is not None and module['rows'] and 'Mean' in module['header']:
+                k = module['header'].index('Mean')
+                worstTile[i, 0] = min(float(row[k]) for row in module['rows'])
+        groups = np.array([sample.split('_', 1)[1] if '_' in sample else '' for sample in samples])
+        scores = np.full((len(samples), 3), np.nan)
+        for group in np.unique(groups):
+            inGroup = groups == group
+            scores[inGroup, 0] = np.nanmedian(robust_z(meanQual[inGroup]), axis=1)
+            scores[inGroup, 1] = np.nanmedian(robust_z(lowerQual[inGroup]), axis=1)
+            scores[inGroup, 2] = robust_z(worstTile[inGroup])[:, 0]
+        averageQual = np.nanmean(meanQual, axis=1)
+    isOutlier = np.any(scores < -threshold, axis=1)
+    rows = []
+    for i, sample in enumerate(samples):
+        rows.append([sample, groups[i], '%.2f' % averageQual[i], '%.2f' % worstTile[i, 0]] + ['%.2f' % z for z in scores[i]] + ['yes' if isOutlier[i] else 'no'])
+    return rows
+
+def file_fingerprint(path):
+    # Size and modification time, to tell whether a file changed since it was cached
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def report_fingerprint(reportPath):
+    # Fingerprint of the file a report is parsed from (fastqc_data.txt for an unzipped report)
+    if reportPath.endswith('.zip'):
+        return file_fingerprint(reportPath)
+    return file_fingerprint(os.path.join(reportPath, 'fastqc_data.txt'))
+
+def modules_file(cachePath, reportPath, fingerprint):
+    # Where the parsed modules of one version of a report are kept: a file of their own in the
+    # <cache>.modules directory, so the cache itself stays small when --modules is not asked for
+    name = hashlib.blake2b((reportPath + '\t' + str(fingerprint)).encode(), digest_size=16).hexdigest()
+    return os.path.join(cachePath + '.modules', name + '.json')
+
+def save_modules(modulesPath, modules):
+    # Write one report's parsed modules to their cache file (best effort: the cache is optional)
+    try:
+        os.makedirs(os.path.dirname(modulesPath), exist_ok=True)
+        with open(modulesPath + '.tmp', 'w') as modulesFile:
+            json.dump(modules, modulesFile)
+        os.replace(modulesPath + '.tmp', modulesPath)
+    except OSError:
+        print("\tCould not write the cache file " + modulesPath)
+
+def load_modules(modulesPath):
+    # One report's cached modules; None if they are not there
+    try:
+        with open(modulesPath, 'r') as modulesFile:
+            return json.load(modulesFile)
+    except (OSError, ValueError):
+        return None
+
+def load_cache(cachePath):
+    # Results of earlier runs, keyed by source path (see --cache); empty if there is no usable cache.
+    #   unzipped: fingerprints of the fastqc.zip files already extracted
+    #   reports: parse_report() results, without the modules (see modules_file)
+    #   alignment: alignment_stats() results
+    cache = {}
+    if cachePath != 'n':
+        try:
+            with open(cachePath, 'r') as cacheFile:
+                cache = json.load(cacheFile)
+        except (OSError, ValueError):
+            print("\tNo usable cache in " + cachePath + ", parsing every library")
+            cache = {}
+    for section in ('unzipped', 'reports', 'alignment'):
+        cache.setdefault(section, {})
+    # Caches written before modules had their own files kept them inline
+    for entry in cache['reports'].values():
+        entry['report'].pop('modules', None)
+    return cache
+
+def save_cache(cache, cachePath, keepPaths):
+    # Write the cache back, dropping entries for files that are no longer in the project
+    if cachePath == 'n':
+        return
+    for section in ('unzipped', 'reports', 'alignment'):
+        cache[section] = {path: entry for path, entry in cache[section].items() if path in keepPaths}
+    if os.path.isdir(cachePath + '.modules'):
+        keepModules = set(os.path.basename(modules_file(cachePath, path, entry['fingerprint'])) for path, entry in cache['reports'].items())
+        for name in os.listdir(cachePath + '.modules'):
+            if name not in keepModules:
+                os.remove(os.path.join(cachePath + '.modules', name))
+    try:
+        with open(cachePath + '.tmp', 'w') as cacheFile:
+            json.dump(cache, cacheFile)
+        os.replace(cachePath + '.tmp', cachePath)
+    except OSError:
+        print("\tCould not write the cache file " + cachePath)
+
+def read_report_file(source, fileName, ifNoneMatch=None):
+    # Contents and ETag of one file of a report (e.g. fastqc_report.html, Images/per_base_quality.png),
+    # read from its fastqc.zip or extracted directory. Open ZipFiles are kept in an LRU cache of
+    # MAX_OPEN_ZIPS and reopened if the zip changes. Contents are None if the ETag matches ifNoneMatch
+    if source.endswith('.zip'):
+        mtime = os.stat(source).st_mtime_ns
+        with openZipsLock:
+            cached = openZips.pop(source, None)
+            if cached is not None and cached[0] != mtime:
+                cached[1].close()
+                cached = None
+            if cached is None:
+                zip = ZipFile(source, 'r')
+                cached = (mtime, zip, report_member(zip, 'fastqc_report.html').split('/')[0])
+            openZips[source] = cached
+            while len(openZips) > MAX_OPEN_ZIPS:
+                openZips.popitem(last=False)[1][1].close()
+            info = cached[1].getinfo(cached[2] + '/' + fileName)
+            etag = '"%08x-%d"' % (info.CRC, info.file_size)
+            if etag == ifNoneMatch:
+                return None, etag
+            return cached[1].read(info), etag
+    # Only files inside the report directory, wherever its links point
+    reportDirec = os.path.realpath(source)
+    filePath = os.path.realpath(os.path.join(reportDirec, fileName))
+    if not filePath.startswith(reportDirec + os.sep):
+        raise KeyError(fileName + " is not in " + source)
+    stat = os.stat(filePath)
+    etag = '"%x-%d"' % (stat.st_mtime_ns, stat.st_size)
+    if etag == ifNoneMatch:
+        return None, etag
+    with open(filePath, 'rb') as reportFile:
+        return reportFile.read(), etag
+
+class ReportHandler(BaseHTTPRequestHandler):
+    # Serves /<report name>/<file>, e.g. /1234_S1_R1_001_fastqc/fastqc_report.html, straight out
+    # of the report's fastqc.zip (see --serve); / lists the reports.
+    # reports maps each report name to its zip or extracted directory
+    reports = {}
+
+    def do_GET(self):
+        path = unquote(urlsplit(self.path).path).strip('/')
+        if path == '':
+            links = ['<a href="/' + name + '/fastqc_report.html">' + name + '</a><br>' for name in sorted(self.reports)]
+            self.send_body(('<html><body>' + '\n'.join(links) + '</body></html>').encode(), 'text/html', None)
+            return
+        reportName, _, fileName = path.partition('/')
+        if fileName == '':
+            fileName = 'fastqc_report.html'
+        source = self.reports.get(reportName)
+        # Relative paths within the report only: no empty (//, absolute), . or .. segments
+        if source is None or any(segment in ('', '.', '..') for segment in fileName.split('/')):
+            self.send_error(404)
+            return
+        try:
+            data, etag = read_report_file(source, fileName, self.headers.get('If-None-Match'))
+        except (KeyError, OSError):
+            self.send_error(404)
+            return
+        if data is None:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_body(data, mimetypes.guess_type(fileName)[0] or 'application/octet-stream', etag)
+
+    def send_body(self, data, contentType, etag):
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+def run_jobs(function, items, jobs, useProcesses):
+    # Yield function(item) for each item, in the order of items. With jobs > 1 the calls run
+    # on a pool: threads for I/O-bound reads, forked processes for (de)compression work.
+    # Executor.map acts as the reorder buffer, holding each result until all earlier ones are out
+    if jobs <= 1:
+        for item in items:
+            yield function(item)
+        return
+    if useProcesses:
+        executor = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork'))
+        chunksize = max(1, len(items) // (jobs * 4))
+    else:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        chunksize = 1
+    with executor:
+        for result in executor.map(function, items, chunksize=chunksize):
+            yield result
 
 ### ........ DEFINE COMMAND LINE ARGUMENTS & VARIABLES ........###
 
@@ -34,12 +712,40 @@ parser.add_argument('--l', type=str,
                     help='.txt file containing a list of library IDs to select', default='all')
 parser.add_argument('--OR', type=str, choices = ("y", "n"), default='n',
                     help='Indicate if you would like to collect overrepresented sequences? (y = yes, n = no')
+parser.add_argument('--ORcatalog', type=str, choices = ("y", "n"), default='n',
+                    help='Write each distinct overrepresented sequence once, with cross-sample counts (OR_catalog.tsv), and as a FASTA for blast (OR_unique.fasta)? (y = yes, n = no)')
+parser.add_argument('--serve', type=int, default=0,
+                    help='Port to serve the fastqc reports on, straight out of the zip files, once the summary is written; the URL column points there (0 = don\'t)')
+parser.add_argument('--host', type=str, default=None,
+                    help='Host name to use in report URLs with --serve (default: this machine\'s fully qualified name)')
+parser.add_argument('--contaminants', type=str, default='n',
+                    help='FASTA of adapters, primers, rRNA and other contaminants to match overrepresented sequences against, offline, by shared k-mers (n = don\'t)')
+parser.add_argument('--kmer', type=int, default=16,
+                    help='k-mer length for matching overrepresented sequences against --contaminants')
 parser.add_argument('--html', type=str,
                     help='directory to create and relocate fastqc reports to for easy viewing', default='n')
+parser.add_argument('--unzip', type=str, choices = ("y", "n"), default='y',
+                    help='Extract the fastqc.zip files? (n = read summary.txt and fastqc_data.txt straight from the zip files)')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='Number of libraries to parse at once (threads for unzipped reports, processes for unzipping or reading fastqc.zip files)')
+parser.add_argument('--modules', type=str, default='n',
+                    help='Directory to write every fastqc_data.txt module to as typed column .npy arrays, ready to memory-map, e.g. fastQC_modules (n = don\'t; needs numpy)')
+parser.add_argument('--outliers', type=str, default='n',
+                    help='.tsv file to write per-base quality outlier calls to, e.g. qualityOutliers.tsv (n = don\'t; needs numpy)')
+parser.add_argument('--outlierZ', type=float, default=3.5,
+                    help='Robust z-score below which a library is flagged as a quality outlier within its R1/R2, trimmed/untrimmed group')
+parser.add_argument('--compress', type=str, choices = compressed_io.COMPRESSIONS, default='none',
+                    help='Compress the .tsv outputs as they are written: gzip (.gz, across --jobs threads) or zstd (.zst, needs the zstandard module)')
+parser.add_argument('--db', type=str, default='n',
+                    help='SQLite QC warehouse to upsert all results into, shared across projects (n = don\'t)')
+parser.add_argument('--cache', type=str, default=None,
+                    help='File to cache parsed results in, so re-runs only parse new or changed libraries (n = no cache; default: .collect_qc_info_cache.json in the --d directory)')
 #parser.add_argument('--fq', metavar = '-fq', type=str, choices = ("t", "u", "a"), default='a',
 #                    help='Collect data from trimmed, untrimmed, or all (options: t = trimmed, u = untrimmed, a = all)')
 
 args = parser.parse_args()
+if args.cache is None:
+    args.cache = os.path.join(args.d, '.collect_qc_info_cache.json')
 
 # Reiterate options:
 print("\nOPTIONS:")
@@ -54,6 +760,60 @@ if args.OR == "n":
     print("\tCOLLECTING OR SEQUENCES: No") 
 elif args.OR == "y":
     print("\tCOLLECTING OVERREPRESENTED SEQUENCES: Yes")
+
+if args.ORcatalog == "y":
+    print("\tCATALOGUING UNIQUE OVERREPRESENTED SEQUENCES: Yes")
+
+if args.contaminants != "n":
+    print("\tMATCHING OVERREPRESENTED SEQUENCES AGAINST: " + args.contaminants + " (k = " + str(args.kmer) + ")")
+
+if args.unzip == "y":
+    print("\tUNZIPPING FASTQC FILES: Yes")
+elif args.unzip == "n":
+    print("\tUNZIPPING FASTQC FILES: No, reading them in place")
+
+print("\tPARALLEL JOBS: " + str(args.jobs))
+
+if args.cache == "n":
+    print("\tCACHE: None, parsing every library")
+else:
+    print("\tCACHE: " + args.cache)
+
+if args.modules != "n":
+    print("\tFASTQC MODULES DIRECTORY: " + args.modules)
+
+if args.outliers != "n":
+    print("\tQUALITY OUTLIERS FILE: " + args.outliers + " (robust z < -" + str(args.outlierZ) + ")")
+
+if args.db != "n":
+    print("\tQC DATABASE: " + args.db)
+
+if args.compress != "none":
+    print("\tCOMPRESSING TSV OUTPUT: " + args.compress)
+
+serveURL = None
+if args.serve != 0:
+    serveURL = 'http://' + (args.host or socket.getfqdn()) + ':' + str(args.serve)
+    print("\tSERVING REPORTS AT: " + serveURL)
+
+if (args.modules != "n" or args.outliers != "n") and np is None:
+    print("\nERROR: --modules and --outliers need numpy, which is not installed")
+    exit()
+
+if args.modules != "n" and modules_path_problem(args.modules):
+    print("\nERROR: --modules " + args.modules + " " + modules_path_problem(args.modules))
+    exit()
+
+if compressed_io.check_compression(args.compress):
+    print("\nERROR: " + compressed_io.check_compression(args.compress))
+    exit()
+
+# The .tsv outputs, named with .gz or .zst when compressed
+summaryName = compressed_io.output_name('fastQC_summary.tsv', args.compress)
+orName = compressed_io.output_name('OR_Sequences.tsv', args.compress)
+alignName = compressed_io.output_name('alignmentStats.tsv', args.compress)
+catalogName = compressed_io.output_name('OR_catalog.tsv', args.compress)
+outliersName = compressed_io.output_name(args.outliers, args.compress)
     
 #if args.fq == "t":
 #    print("\tFASTQ TYPE: Only collecting data from TRIMMED fastq files") 
@@ -119,46 +879,55 @@ else:
 
 # STEP 3) Scan through directory & unzip any zipped files
 #  (based on provided list of library IDs, or all by default)
-print("\n\t...NOW UNZIPPING FILES...\n")
-
-unzipList = []
 if args.l == 'all':
-    for root, dirs, files in os.walk(args.d):
-        for file in files:
-            if file.endswith('fastqc.zip'):
-                fileToUnzip = os.path.join(root, file)
-                basename = file.split('_')[0]
-                if basename in libFile_list_sorted:
-                    unzipList.append(fileToUnzip)
-                    #print(basename)
-    #print(unzipList)
+    selectedLibs = libFile_list_sorted
 else:
-    for root, dirs, files in os.walk(args.d):
-        for file in files:
-            if file.endswith('fastqc.zip'):
-                fileToUnzip = os.path.join(root, file)
-                basename = file.split('_')[0]
-                if basename in matchedListInOrder:
-                    unzipList.append(fileToUnzip)
-                    #print(basename)
-    #print(unzipList)
-    
-# Unzip files in the list
-for i in unzipList:
-    #print("UNZIPPING " + i + ' into the same directory ...')
-    zipDirec = i.rsplit('/', 1)[0]
-    #print(zipDirec)
-    with ZipFile(i, 'r') as zip:
-    #    print(root)
-        zip.extractall(zipDirec)
+    selectedLibs = matchedListInOrder
+
+# One pass over the project tree builds the index every later step reads from
+print("\n\t...NOW SCANNING " + args.d + "...\n")
+projectIndex = scan_project(args.d)
+
+unzipList = []
+reportList = []
+alignFileList = []
+for libID, libFiles in projectIndex.items():
+    if libID in selectedLibs:
+        unzipList += libFiles['zips']
+        reportList += libFiles['reports']
+        alignFileList += libFiles['align'] + libFiles['counts']
+unzipList = sorted(unzipList)
+#print(unzipList)
 
-print("\n\tDONE UNZIPPING FILES\n")
+# Results of earlier runs; only new or changed files are unzipped and parsed again
+cache = load_cache(args.cache)
+
+# Unzip files in the list, or leave them zipped and read each report in place (--unzip n)
+if args.unzip == 'y':
+    print("\n\t...NOW UNZIPPING FILES...\n")
+    zipFingerprints = {}
+    toUnzip = []
+    for i in unzipList:
+        zipFingerprints[i] = file_fingerprint(i)
+        reportDirec = os.path.join(i.rsplit('/', 1)[0], report_name(i))
+        if cache['unzipped'].get(i) != zipFingerprints[i] or not os.path.isdir(reportDirec):
+            toUnzip.append(i)
+        elif reportDirec not in reportList:
+            reportList.append(reportDirec)
+    for reportDirec in run_jobs(extract_report, toUnzip, args.jobs, useProcesses=True):
+        if reportDirec not in reportList:
+            reportList.append(reportDirec)
+    for i in toUnzip:
+        cache['unzipped'][i] = zipFingerprints[i]
+    print("\n\tDONE UNZIPPING FILES (" + str(len(unzipList) - len(toUnzip)) + " ALREADY UNZIPPED)\n")
+    reportList = sorted(reportList)
+else:
+    print("\n\tNOT UNZIPPING, READING REPORTS STRAIGHT FROM THE ZIP FILES\n")
+    reportList = unzipList
 
 
 # STEP 4) Write the headers for the output files
-with open('fastQC_summary.tsv', 'a') as flatfile:
-    flatfile.seek(0)
-    flatfile.truncate()
+with compressed_io.open_output(summaryName, 'w', args.compress, args.jobs) as flatfile:
     flatfile.write('SAMPLE')
     flatfile.write('\t')
     flatfile.write('BasicStats')
@@ -190,9 +959,7 @@ with open('fastQC_summary.tsv', 'a') as flatfile:
     flatfile.close
 
 if args.OR == "y":
-    with open('OR_Sequences.tsv', 'a') as flatfile:
-        flatfile.seek(0)
-        flatfile.truncate()
+    with compressed_io.open_output(orName, 'w', args.compress, args.jobs) as flatfile:
         flatfile.write('SAMPLE')
         flatfile.write('\t')
         flatfile.write('Sequence')
@@ -202,12 +969,13 @@ if args.OR == "y":
         flatfile.write('Percentage')
         flatfile.write('\t')
         flatfile.write('Possible_source')
+        if args.contaminants != 'n':
+            flatfile.write('\t')
+            flatfile.write('Kmer_match')
         flatfile.write('\n')
         flatfile.close 
 
-with open('alignmentStats.tsv', 'a') as flatfile:
-    flatfile.seek(0)
-    flatfile.truncate()
+with compressed_io.open_output(alignName, 'w', args.compress, args.jobs) as flatfile:
     flatfile.write('SAMPLE')
     flatfile.write('\t')
     flatfile.write('reads_HS')
@@ -238,312 +1006,186 @@ else:
     else:
         print ("Successfully created the directory " + args.html)
     
+    
 # STEP 5) Write the summary file, copy all html files to a folder for easy viewing (if args.html provided)
-if args.l == 'all':
-    for root, dirs, files in os.walk(args.d):
-        if root.endswith('fastqc'):
-            #print(root)
-            fileName = root.rsplit("/", 1)[1]
-            #print(fileName)
-            basename = fileName.split("_")[0]
-            #print(basename)
-            if basename in libFile_list_sorted:
-                summaryPath = os.path.join(root, 'summary.txt')
-                dataPath = os.path.join(root, 'fastqc_data.txt')
-                url = os.path.join(root, 'fastqc_report.html')
-                #print(summaryPath)
-                if args.html == "n":
-                    #print("not moving html files")
-                    url2 = os.path.join(root, 'fastqc_report.html')
-                else:
-                    newFile = root.rsplit('/', 1)
-                    #print(newFile)
-                    #print(" is the file to create")
-                    newDirec = os.path.join(args.html, newFile[1])
-                    #print(newDirec + " is the directory to create")
-                    dst = os.path.join(args.html, newFile[1], 'fastqc_report.html')
-                    #print(dst + " is the destination")
-                    url2 = os.path.join(args.html, newFile[1], 'fastqc_report.html')
-                    # UNCOMMENT IF USING RAVEN:
-                    #url2 = os.path.join('http://raven.anr.udel.edu/fastqc_reports', newFile[1], 'fastqc_report.html')
-                    #print(url2 + " is url to write to file")
-                    try:
-                        os.mkdir(newDirec)
-                    except OSError:
-                        #print ("Creation of the directory failed" + newDirec)
-                        print(newDirec + " already exists")
-                    else:
-                        print ("Successfully created the directory " + newDirec)
-                    copyfile(url, dst)
-                with open(str(summaryPath), 'r') as summaryFile, open(str(dataPath), 'r') as dataFile, open('fastQC_summary.tsv', 'a') as summaryOutFile:
-                #summaryOutFile.write("sample\t")
-                    for i, line in enumerate(summaryFile):
-                        if i ==0:
-                            #print(line)
-                            filename = line.split('\t')[2]
-                            #print(filename)
-                            libNum = filename.split('_')[0]
-                            if re.match('^\d{3,4}_S.{1,14}_val_1', filename):
-                                sample = (libNum + "_R1_trimmed")
-                            if re.match('^\d{3,4}_S.{1,14}_val_2', filename):
-                                sample = (libNum + "_R2_trimmed")
-                            if re.match('^\d{3,4}_S.{1,7}_R1_001.f', filename):
-                                sample = (libNum + "_R1_untrimmed")
-                            if re.match('^\d{3,4}_S.{1,7}_R2_001.f', filename):
-                                sample = (libNum + "_R2_untrimmed")
-                            summaryOutFile.write(sample +" \t")
-                        result = line.split('\t')[0]
-                        summaryOutFile.write(result + "\t")
-                    summaryOutFile.write(url2 + "\t")
-                    for i, line in enumerate(dataFile):
-                        if i ==6:
-                            #print(line)
-                            totalSeq = line.split('\t')[1]
-                            #print(totalSeq)
-                            #summaryOutFile.write(totalSeq + "\n")
-                            summaryOutFile.write(totalSeq)
-                summaryOutFile.close()
-else:
-    for root, dirs, files in os.walk(args.d):
-        if root.endswith('fastqc'):
-            #print(root)
-            fileName = root.rsplit("/", 1)[1]
-            #print(fileName)
-            basename = fileName.split("_")[0]
-            #print(basename)
-            if basename in matchedListInOrder:
-                summaryPath = os.path.join(root, 'summary.txt')
-                dataPath = os.path.join(root, 'fastqc_data.txt')
-                url = os.path.join(root, 'fastqc_report.html')
-                #print(summaryPath)
-                if args.html == "n":
-                    #print("not moving html files")
-                    url2 = os.path.join(root, 'fastqc_report.html')
-                else:
-                    newFile = root.rsplit('/', 1)
-                    #print(newFile)
-                    #print(" is the file to create")
-                    newDirec = os.path.join(args.html, newFile[1])
-                    #print(newDirec + " is the directory to create")
-                    dst = os.path.join(args.html, newFile[1], 'fastqc_report.html')
-                    #print(dst + " is the destination")
-                    url2 = os.path.join(args.html, newFile[1], 'fastqc_report.html')
-                    # UNCOMMENT IF USING RAVEN:
-                    #url2 = os.path.join('http://raven.anr.udel.edu/fastqc_reports', newFile[1], 'fastqc_report.html')
-                    #print(url2 + " is url to write to file")
-                    try:
-                        os.mkdir(newDirec)
-                    except OSError:
-                        #print ("Creation of the directory failed" + newDirec)
-                        print(newDirec + " already exists")
-                    else:
-                        print ("Successfully created the directory " + newDirec)
-                    copyfile(url, dst)
-                with open(str(summaryPath), 'r') as summaryFile, open(str(dataPath), 'r') as dataFile, open('fastQC_summary.tsv', 'a') as summaryOutFile:
-            #summaryOutFile.write("sample\t")
-                    for i, line in enumerate(summaryFile):
-                        if i ==0:
-                            #print(line)
-                            filename = line.split('\t')[2]
-                            #print(filename)
-                            libNum = filename.split('_')[0]
-                            if re.match('^\d{3,4}_S.{1,14}_val_1', filename):
-                                sample = (libNum + "_R1_trimmed")
-                            if re.match('^\d{3,4}_S.{1,14}_val_2', filename):
-                                sample = (libNum + "_R2_trimmed")
-                            if re.match('^\d{3,4}_S.{1,7}_R1_001.f', filename):
-                                sample = (libNum + "_R1_untrimmed")
-                            if re.match('^\d{3,4}_S.{1,7}_R2_001.f', filename):
-                                sample = (libNum + "_R2_untrimmed")
-                            summaryOutFile.write(sample +" \t")
-                        result = line.split('\t')[0]
-                        summaryOutFile.write(result + "\t")
-                    summaryOutFile.write(url2 + "\t")
-                    for i, line in enumerate(dataFile):
-                        if i ==6:
-                            #print(line)
-                            totalSeq = line.split('\t')[1]
-                            #print(totalSeq)
-                            #summaryOutFile.write(totalSeq + "\n")
-                            summaryOutFile.write(totalSeq)
-                summaryOutFile.close()
+#   With --jobs > 1 the reports are parsed concurrently; rows are still written in reportList order
+#   Reports already in the cache with the same size and mtime are not read again; their modules
+#   (only read when needed) are kept in files of their own next to the cache
+needModules = (args.modules != "n" or args.outliers != "n")
+reportFingerprints = {}
+reportModules = {}
+toParse = []
+for reportPath in reportList:
+    reportFingerprints[reportPath] = report_fingerprint(reportPath)
+    cachedReport = cache['reports'].get(reportPath)
+    if cachedReport is None or cachedReport['fingerprint'] != reportFingerprints[reportPath]:
+        toParse.append(reportPath)
+    elif needModules:
+        reportModules[reportPath] = load_modules(modules_file(args.cache, reportPath, reportFingerprints[reportPath])) if args.cache != 'n' else None
+        if reportModules[reportPath] is None:
+            toParse.append(reportPath)
+print("\tPARSING " + str(len(toParse)) + " NEW OR CHANGED REPORTS, " + str(len(reportList) - len(toParse)) + " FROM THE CACHE\n")
+parseReport = partial(parse_report, parseModules=needModules)
+for reportPath, parsedReport in zip(toParse, run_jobs(parseReport, toParse, args.jobs, useProcesses=(args.unzip == 'n'))):
+    if needModules:
+        reportModules[reportPath] = parsedReport.pop('modules')
+        if args.cache != 'n':
+            save_modules(modules_file(args.cache, reportPath, reportFingerprints[reportPath]), reportModules[reportPath])
+    cache['reports'][reportPath] = {'fingerprint': reportFingerprints[reportPath], 'report': parsedReport}
+
+publishReport = partial(publish_report, htmlDirec=args.html)
+orRows = []
+reportURLs = {}
+published = {'unchanged': 0, 'linked': 0, 'reflinked': 0, 'copied': 0}
+with compressed_io.open_output(summaryName, 'a', args.compress, args.jobs) as summaryOutFile:
+    for reportPath, (url2, action) in zip(reportList, run_jobs(publishReport, reportList, args.jobs, useProcesses=False)):
+        if args.serve != 0:
+            url2 = serveURL + '/' + report_name(reportPath) + '/fastqc_report.html'
+        reportURLs[reportPath] = url2
+        published[action] += 1
+        parsedReport = cache['reports'][reportPath]['report']
+        summaryOutFile.write(summary_row(parsedReport, url2))
+        if args.OR == "y":
+            orRows += parsedReport['OR']
 
+if args.html != "n":
+    print("\n\tPUBLISHED HTML REPORTS: " + ", ".join(str(published[action]) + " " + action for action in published))
 print("\n\tDONE WRITING SUMMARY FILE\n")
 
 
 # STEP 6) Write the OR sequences file, if desired
+#   With --contaminants, each distinct sequence is matched once against a k-mer index of that FASTA
+kmerMatches = {}
+if args.contaminants != "n" and (args.OR == "y" or args.ORcatalog == "y"):
+    references = read_fasta(args.contaminants)
+    kmerIndex = kmer_index(references, args.kmer)
+    for reportPath in reportList:
+        for line in cache['reports'][reportPath]['report']['OR']:
+            sequence = line.split('\t')[1].upper()
+            if sequence not in kmerMatches:
+                kmerMatches[sequence] = classify_sequence(sequence, references, kmerIndex, args.kmer)
+    print("\n\tMATCHED " + str(len(kmerMatches)) + " DISTINCT OR SEQUENCES AGAINST " + str(len(references)) + " SEQUENCES IN " + args.contaminants + "\n")
+
 if args.OR == "y":
-    if args.l == 'all':
-        for root, dirs, files in os.walk(args.d):
-            if root.endswith('fastqc'):
-                #print(root)
-                fileName = root.rsplit("/", 1)[1]
-                #print(fileName)
-                basename = fileName.split("_")[0]
-                #print(basename)
-                if basename in libFile_list_sorted:
-                    dataPath = os.path.join(root, 'fastqc_data.txt')
-                    #print(".")
-                    #print(dataPath + " IS THE DATA FILE PATH")
-                with open(str(dataPath), 'r') as dataFile, open('OR_Sequences.tsv', 'a') as dataOutFile:
-                    #dataOutFile.write("sample\t")
-                    for i, line in enumerate(dataFile):
-                        if i ==3:
-                            #print(line)
-                            filename = line.split('\t')[1]
-                            print("Getting OR sequences in " + filename)
-                            libNum = filename.split('_')[0]
-                            if re.match('^\d{3,4}_S.{1,14}_val_1', filename):
-                                sample = (libNum + "_R1_trimmed")
-                            if re.match('^\d{3,4}_S.{1,7}_R1_001.f', filename):
-                                sample = (libNum + "_R1_untrimmed")
-                            if re.match('^\d{3,4}_S.{1,14}_val_2', filename):
-                                sample = (libNum + "_R2_trimmed")
-                            if re.match('^\d{3,4}_S.{1,7}_R2_001.f', filename):
-                                sample = (libNum + "_R2_untrimmed")
-                            #dataOutFile.write(sample +" \t")
-                            inRecordingMode = False
-                            for line in dataFile:
-                                if not inRecordingMode:
-                                    if line.startswith('#Sequence'):
-                                        inRecordingMode = True
-                                elif line.startswith('>>END_MODULE'):
-                                    inRecordingMode = False
-                                    #return line
-                                else:
-                                    #print(sample, line)
-                                    dataOutFile.write(sample + "\t" + line)
-                        #result = line.split('\t')[0]
-                dataOutFile.close()
-    else:
-        for root, dirs, files in os.walk(args.d):
-            if root.endswith('fastqc'):
-                #print(root)
-                fileName = root.rsplit("/", 1)[1]
-                #print(fileName)
-                basename = fileName.split("_")[0]
-                #print(basename)
-                if basename in matchedListInOrder:
-                    dataPath = os.path.join(root, 'fastqc_data.txt')
-                    #print(".")
-                    #print(dataPath + " IS THE DATA FILE PATH")
-                with open(str(dataPath), 'r') as dataFile, open('OR_Sequences.tsv', 'a') as dataOutFile:
-                    #dataOutFile.write("sample\t")
-                    for i, line in enumerate(dataFile):
-                        if i ==3:
-                            #print(line)
-                            filename = line.split('\t')[1]
-                            print("Getting OR sequences in " + filename)
-                            libNum = filename.split('_')[0]
-                            if re.match('^\d{3,4}_S.{1,14}_val_1', filename):
-                                sample = (libNum + "_R1_trimmed")
-                            if re.match('^\d{3,4}_S.{1,7}_R1_001.f', filename):
-                                sample = (libNum + "_R1_untrimmed")
-                            if re.match('^\d{3,4}_S.{1,14}_val_2', filename):
-                                sample = (libNum + "_R2_trimmed")
-                            if re.match('^\d{3,4}_S.{1,7}_R2_001.f', filename):
-                                sample = (libNum + "_R2_untrimmed")
-                            #dataOutFile.write(sample +" \t")
-                            inRecordingMode = False
-                            for line in dataFile:
-                                if not inRecordingMode:
-                                    if line.startswith('#Sequence'):
-                                        inRecordingMode = True
-                                elif line.startswith('>>END_MODULE'):
-                                    inRecordingMode = False
-                                    #return line
-                                else:
-                                    #print(sample, line)
-                                    dataOutFile.write(sample + "\t" + line)
-                        #result = line.split('\t')[0]
-                dataOutFile.close()
+    with compressed_io.open_output(orName, 'a', args.compress, args.jobs) as dataOutFile:
+        for line in orRows:
+            if kmerMatches:
+                line = line.rstrip('\n') + '\t' + kmerMatches[line.split('\t')[1].upper()] + '\n'
+            dataOutFile.write(line)
     print("\n\tDONE WRITING OR SEQUENCE FILE \n")
 
-# STEP 7) Get mapping statistics from hisat2 and featurecounts                               
+# Write each distinct OR sequence once, with how many samples contain it, and a FASTA of them for blast
+if args.ORcatalog == "y":
+    allORRows = []
+    for reportPath in reportList:
+        allORRows += cache['reports'][reportPath]['report']['OR']
+    catalog = or_catalog(allORRows)
+    with compressed_io.open_output(catalogName, 'w', args.compress, args.jobs) as catalogFile, open('OR_unique.fasta', 'w') as fastaFile:
+        catalogFile.write('ID\tSequence\tSamples\tLibraries\tTotalCount\tSumPercentage\tMaxPercentage\tPossible_source')
+        if kmerMatches:
+            catalogFile.write('\tKmer_match')
+        catalogFile.write('\n')
+        for n, (sequence, entry) in enumerate(catalog, 1):
+            seqID = 'OR_%06d' % n
+            catalogFile.write(seqID + '\t' + sequence + '\t' + str(len(entry['samples'])) + '\t' + str(len(entry['libraries'])) + '\t' + str(entry['count']) + '\t' + '%.4f' % entry['sumPercentage'] + '\t' + '%.4f' % entry['maxPercentage'] + '\t' + entry['source'])
+            if kmerMatches:
+                catalogFile.write('\t' + kmerMatches[sequence.upper()])
+            catalogFile.write('\n')
+            fastaFile.write('>' + seqID + ' samples=' + str(len(entry['samples'])) + ' maxPercentage=' + '%.4f' % entry['maxPercentage'] + '\n' + sequence + '\n')
+    print("\n\tDONE WRITING " + str(len(catalog)) + " UNIQUE OR SEQUENCES (FROM " + str(len(allORRows)) + ") TO " + catalogName + " AND OR_unique.fasta\n")
 
+# STEP 7) Write every module of fastqc_data.txt to NumPy files of typed columns, if desired
+if needModules:
+    samples = [cache['reports'][reportPath]['report']['summary'].split('\t')[0].strip() for reportPath in reportList]
+    moduleList = [reportModules[reportPath] for reportPath in reportList]
+if args.modules != "n":
+    write_module_arrays(samples, reportList, moduleList, args.modules)
+    print("\n\tDONE WRITING FASTQC MODULES TO " + args.modules + "\n")
 
+# Flag libraries with poor per-base quality compared to the rest of their group, if desired
+if args.outliers != "n":
+    with compressed_io.open_output(outliersName, 'w', args.compress, args.jobs) as outlierFile:
+        outlierFile.write('SAMPLE\tgroup\tmeanQual\tworstTileDeviation\tz_meanQual\tz_lowerQuartile\tz_worstTile\tOUTLIER\n')
+        for row in quality_outliers(samples, moduleList, args.outlierZ):
+            outlierFile.write('\t'.join(row) + '\n')
+    print("\n\tDONE WRITING QUALITY OUTLIERS TO " + outliersName + "\n")
 
+# STEP 8) Get mapping statistics from hisat2 and featurecounts                               
 
-# Store the libraries we want in a list
-alignFileList = []
-#assignFileList = []
-if args.l == 'all':
-    for root, dirs, files in os.walk(args.d):
-        if root.endswith('hisat_out'):
-            fileName = root.rsplit("/", 2)[1]
-            #print(fileName)
-            basename = fileName.split("_")[0]
-            #print(basename)
-            if basename in libFile_list_sorted:
-                alignFilePath = os.path.join(root, 'align_summary.txt')
-                #print(alignFilePath + " is the alignment File we want")
-                alignFileList.append(alignFilePath)
-                #print(".")
-                #print(dataPath + " IS THE DATA FILE PATH")
-        if root.endswith('rawcounts_output'):
-            fileName = root.rsplit("/", 2)[1]
-            #print(fileName)
-            basename = fileName.split("_")[0]
-            #print(basename)
-            if basename in libFile_list_sorted:
-                assignFilePath = os.path.join(root, 'countRunsummary.txt')
-                #print(alignFilePath + " is the alignment File we want")
-                alignFileList.append(assignFilePath)
-                #print(".")
-                #print(dataPath + " IS THE DATA FILE PATH")
-else:
-    for root, dirs, files in os.walk(args.d):
-        if root.endswith('hisat_out'):
-            fileName = root.rsplit("/", 2)[1]
-            #print(fileName)
-            basename = fileName.split("_")[0]
-            #print(basename)
-            if basename in matchedListInOrder:
-                alignFilePath = os.path.join(root, 'align_summary.txt')
-                #print(alignFilePath + " is the alignment File we want")
-                alignFileList.append(alignFilePath)
-                #print(".")
-                #print(dataPath + " IS THE DATA FILE PATH")
-        if root.endswith('rawcounts_output'):
-            fileName = root.rsplit("/", 2)[1]
-            #print(fileName)
-            basename = fileName.split("_")[0]
-            #print(basename)
-            if basename in matchedListInOrder:
-                assignFilePath = os.path.join(root, 'countRunsummary.txt')
-                #print(alignFilePath + " is the alignment File we want")
-                alignFileList.append(assignFilePath)
-                #print(".")
-                #print(dataPath + " IS THE DATA FILE PATH")
+# The hisat2 and featurecounts summaries were found by the project scan (STEP 3)
 alignFiles_sorted = sorted(alignFileList)
 #print(alignFiles_sorted)
 
 
-with open('alignmentStats.tsv', 'a') as outFile:
+with compressed_io.open_output(alignName, 'a', args.compress, args.jobs) as outFile:
     for i in alignFiles_sorted:
-        with open(i) as inFile:
-                #print(i)
-            fileName = i.rsplit("/", 3)[1]
-            basename = fileName.split("_")[0]
-            for i, line in enumerate(inFile):
-                if re.search("reads", line):
-                    reads = line.split(" ")[0]
-                if re.search("overall", line):
-                    alignPercent = line.split(" ")[0]
-                    #print(basename + '\t' + reads + '\t' + alignPercent + '\t', end = ' ')
-                    outFile.write(basename + '\t' + reads + '\t' + alignPercent + '\t')
-                    #alignRate = basename + '\t' + reads + '\t' + alignPercent + '\t'
-                    #print(alignRate)
-                    #outFile.write(alignRate)
-                if re.search("Total", line):
-                    total = (line.split(" ")[7])
-                if re.search("Successfully", line):
-                    percent=(line.split(" ")[9])
-                    #assignRate = (basename + '\t' + total + '\t' + percent + '\n')
-                    #print(basename + '\t' + total + '\t' + percent + '\n')
-                    outFile.write(basename + '\t' + total + '\t' + percent + '\n')
+        fingerprint = file_fingerprint(i)
+        cachedStats = cache['alignment'].get(i)
+        if cachedStats is None or cachedStats['fingerprint'] != fingerprint:
+            cachedStats = {'fingerprint': fingerprint, 'stats': alignment_stats(i)}
+            cache['alignment'][i] = cachedStats
+        outFile.write(cachedStats['stats'])
 
 print("\n\tDONE WRITING ALIGNMENT STATS FILE\n")
+
+# STEP 9) Upsert the results into the SQLite QC warehouse, if desired
+if args.db != "n":
+    project = os.path.basename(os.path.normpath(args.d))
+    summaryModules = ['BasicStats', 'PerBaseSeqQual', 'PerTileSeqQual', 'PerSeqQualScore', 'PerBaseSeqContent', 'PerSeqGC', 'PerBaseN', 'SeqLengthDist', 'SeqDupLevels', 'OverrepSeq', 'AdapterCont']
+    libraryRows = []
+    statusRows = []
+    orSamples = []
+    orDBRows = []
+    for reportPath in reportList:
+        parsedReport = cache['reports'][reportPath]['report']
+        fields = parsedReport['summary'].split('\t')
+        library, readType = qc_warehouse.split_sample(fields[0])
+        libraryRows.append((library, readType, project, reportPath, reportURLs[reportPath], report_date(reportPath), qc_warehouse.to_number(parsedReport['totalSeq'], int)))
+        for module, status in zip(summaryModules, fields[1:]):
+            statusRows.append((library, readType, module, status))
+        orSamples.append((library, readType))
+        for line in parsedReport['OR']:
+            orFields = line.rstrip('\n').split('\t') + ['']
+            orDBRows.append((library, readType, orFields[1], qc_warehouse.to_number(orFields[2], int), qc_warehouse.to_number(orFields[3]), orFields[4]))
+    alignRows = []
+    assignRows = []
+    for i in alignFiles_sorted:
+        stats = cache['alignment'][i]['stats'].rstrip('\n').split('\t')
+        if len(stats) < 3:
+            continue
+        run = i.rsplit("/", 3)[1]
+        if i.endswith('align_summary.txt'):
+            alignRows.append((stats[0], run, project, qc_warehouse.to_number(stats[1], int), qc_warehouse.to_number(stats[2])))
+        else:
+            assignRows.append((stats[0], run, project, qc_warehouse.to_number(stats[1], int), qc_warehouse.to_number(stats[2])))
+    conn = qc_warehouse.connect(args.db)
+    with conn:
+        qc_warehouse.upsert_libraries(conn, libraryRows)
+        qc_warehouse.upsert_module_status(conn, statusRows)
+        qc_warehouse.replace_overrepresented(conn, orSamples, orDBRows)
+        qc_warehouse.upsert_alignment(conn, alignRows)
+        qc_warehouse.upsert_assignment(conn, assignRows)
+    conn.close()
+    print("\n\tDONE UPSERTING " + str(len(libraryRows)) + " REPORTS INTO " + args.db + "\n")
+
+# Save the cache for the next run, keeping entries for every file still in the project
+keepPaths = set(reportList)
+for libFiles in projectIndex.values():
+    for files in libFiles.values():
+        keepPaths.update(files)
+save_cache(cache, args.cache, keepPaths)
+
+# STEP 10) Serve the reports straight out of their zip files, if desired (until Ctrl-C)
+if args.serve != 0:
+    for reportPath in reportList + unzipList:
+        ReportHandler.reports[report_name(reportPath)] = reportPath
+    server = ThreadingHTTPServer(('', args.serve), ReportHandler)
+    print("\n\tSERVING " + str(len(ReportHandler.reports)) + " REPORTS AT " + serveURL + " (Ctrl-C to stop)\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
                 
 exit()
        
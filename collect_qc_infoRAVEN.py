@@ -13,6 +13,8 @@
 # - Allow specification of trimmed or untrimmed fastq files
 # - Copy .html files to location they can be viewed on server (/var/www/html/fastqc_reports)
 # - Parse OR sequences file to get total percentages and automatically submit to blast
+# NOTE: collect_qc_info.py --serve <port> --host raven.anr.udel.edu serves the reports straight out of
+# the fastqc.zip files, with no copies into /var/www/html/fastqc_reports
 
 ### ........ IMPORT MODULES ........###
 
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+### ........ ABOUT ........###
+
+# Compressed text files shared by join_exprs_table.py and collect_qc_info.py (--compress).
+# Output is compressed as it is written, so the uncompressed table never touches disk:
+#   gzip   the text is cut into blocks that are compressed on several threads and written, in
+#          order, as consecutive gzip members (as pigz -i does); gzip -d, zcat, R and Python's
+#          gzip module all read them back as one file
+#   zstd   zstandard's own multithreaded compressor (needs the zstandard module)
+# Opening a compressed file for appending ('a') adds new members or frames after the old ones,
+# which is still a valid file.
+# open_input reads plain, gzip or zstd files alike, telling them apart by their first bytes.
+
+### ........ IMPORT MODULES ........###
+
+import gzip
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+SUFFIXES = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+BLOCK_SIZE = 4 * 2**20      # bytes of text compressed as one gzip member
+
+### ........ DEFINE FUNCTIONS ........###
+
+class ParallelGzipWriter(io.RawIOBase):
+    # Binary file that gzips what is written to it in BLOCK_SIZE blocks on a pool of threads
+    # (zlib releases the GIL), writing the members in order. At most two blocks per thread are
+    # waiting at any time, so memory stays bounded however much is written
+
+    def __init__(self, path, mode='w', threads=1, level=6):
+        super().__init__()
+        self.file = open(path, mode + 'b')
+        self.pool = ThreadPoolExecutor(max(threads, 1))
+        self.maxPending = 2 * max(threads, 1)
+        self.pending = deque()
+        self.block = bytearray()
+        self.level = level
+        self.empty = (mode == 'w')
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.block += data
+        if len(self.block) >= BLOCK_SIZE:
+            self.submit_block()
+        return len(data)
+
+    def submit_block(self):
+        self.pending.append(self.pool.submit(gzip.compress, bytes(self.block), self.level, mtime=0))
+        self.block = bytearray()
+        self.empty = False
+        while len(self.pending) > self.maxPending:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # A new file with nothing written still gets one (empty) member, to be a valid gzip file
+            if self.block or self.empty:
+                self.submit_block()
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown()
+            self.file.close()
+            super().close()
+
+def output_name(path, compression):
+    # The name of an output file once compressed, e.g. table.tsv -> table.tsv.gz
+    return path + SUFFIXES[compression]
+
+def check_compression(compression):
+    # None if compression can be written here, or why not
+    if compression == 'zstd' and zstandard is None:
+        return "--compress zstd needs the zstandard module (pip install zstandard)"
+    return None
+
+def open_output(path, mode='w', compression='none', threads=1):
+    # A text file to write ('w') or append to ('a'), compressed as it is written
+    if compression == 'gzip':
+        return io.TextIOWrapper(io.BufferedWriter(ParallelGzipWriter(path, mode, threads)))
+    if compression == 'zstd':
+        writer = zstandard.ZstdCompressor(level=3, threads=threads).stream_writer(open(path, mode + 'b'))
+        return io.TextIOWrapper(writer)
+    return open(path, mode)
+
+def file_compression(path):
+    # 'gzip', 'zstd' or 'none', from the first bytes of the file
+    with open(path, 'rb') as inFile:
+        magic = inFile.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return 'none'
+
+def open_input(path):
+    # A text file to read, decompressed as it is read if it is gzip or zstd
+    compression = file_compression(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rt')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise OSError(path + " is zstd compressed and the zstandard module is not installed")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True)
+        return io.TextIOWrapper(io.BufferedReader(reader))
+    return open(path, 'r')
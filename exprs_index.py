@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+### ........ ABOUT ........###
+
+# Random-access index over a joined expression table (<outFile>_TPM.tsv and the like, from
+# join_exprs_table.py or its join scripts), shared by join_exprs_table.py, which writes it next
+# to every table it joins, and query_exprs_table.py, which reads it.
+# The index, <table>.idx, is a small text file:
+#   #size       size of the table in bytes when it was indexed (a different size = stale index)
+#   #libraries  the library IDs, in column order (the first value column is column 1)
+#   then one line per gene: gene ID, byte offset of its row in the table
+# With it a lookup reads only the requested rows, through mmap, instead of the whole table.
+
+### ........ IMPORT MODULES ........###
+
+import mmap
+import os
+
+INDEX_SUFFIX = '.idx'
+
+### ........ DEFINE FUNCTIONS ........###
+
+def write_index(tablePath, libIDs=None):
+    # Index a joined table (header row of library IDs, then one row per gene, split on blanks)
+    # in one sequential read. A table from a join script has no header row: give its library IDs
+    # (JMP_header.txt) as libIDs. Returns the number of genes indexed
+    nGenes = 0
+    with open(tablePath, 'rb') as tableFile, open(tablePath + INDEX_SUFFIX + '.tmp', 'w') as indexFile:
+        if libIDs is None:
+            libIDs = tableFile.readline().decode().split()[1:]
+        indexFile.write('#size\t' + str(os.path.getsize(tablePath)) + '\n')
+        indexFile.write('#libraries\t' + '\t'.join(libIDs) + '\n')
+        offset = tableFile.tell()
+        for line in tableFile:
+            fields = line.split(None, 1)
+            if fields:
+                indexFile.write(fields[0].decode() + '\t' + str(offset) + '\n')
+                nGenes += 1
+            offset += len(line)
+    os.replace(tablePath + INDEX_SUFFIX + '.tmp', tablePath + INDEX_SUFFIX)
+    return nGenes
+
+def read_index(tablePath):
+    # (library IDs, {gene ID: byte offset}) of an indexed table; None if it has no index or the
+    # table has changed size since it was indexed
+    if not os.path.exists(tablePath + INDEX_SUFFIX):
+        return None
+    offsets = {}
+    with open(tablePath + INDEX_SUFFIX, 'r') as indexFile:
+        size = int(indexFile.readline().split('\t')[1])
+        if size != os.path.getsize(tablePath):
+            return None
+        libIDs = indexFile.readline().rstrip('\n').split('\t')[1:]
+        for line in indexFile:
+            geneID, offset = line.rstrip('\n').split('\t')
+            offsets[geneID] = int(offset)
+    return libIDs, offsets
+
+def query_table(tablePath, index, geneIDs, libIDs):
+    # The rows of geneIDs, with the values of libIDs only (every library if libIDs is empty), read
+    # from the memory-mapped table. Returns (rows, gene IDs not in the table); each row is the gene
+    # ID followed by its values as text
+    tableLibs, offsets = index
+    columns = [tableLibs.index(libID) + 1 for libID in libIDs] if libIDs else list(range(1, len(tableLibs) + 1))
+    rows = []
+    missing = []
+    with open(tablePath, 'rb') as tableFile, mmap.mmap(tableFile.fileno(), 0, access=mmap.ACCESS_READ) as table:
+        for geneID in geneIDs:
+            if geneID not in offsets:
+                missing.append(geneID)
+                continue
+            start = offsets[geneID]
+            end = table.find(b'\n', start)
+            fields = table[start:end if end != -1 else len(table)].decode().split()
+            rows.append([fields[0]] + [fields[column] for column in columns])
+    return rows, missing
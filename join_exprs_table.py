@@ -10,6 +10,7 @@
 #   Additionally, create two tab-separated files with ordered headers for use in R and JMP
 
 # FUTURE: make sure files are in same order and have same number of lines, columns, order etc before writing join script
+#   (--mode native and matrix compare each file's gene-ID column with the first library's and report those that differ)
 #   Useful script to check that number of columns is the same in every row:
 #       awk '{print NF}' <file> | uniq -c
 #   After running join script, append the file with the header list
@@ -44,10 +45,965 @@
 ### ........ IMPORT MODULES ........###
 
 import glob
+import hashlib
 import os
 import sys
 import argparse
+import fnmatch
 import re
+import shlex
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import compressed_io
+import exprs_index
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+### ........ DEFINE FUNCTIONS ........###
+
+# The per-library file to join for each kind of data, relative to the library output directory
+DATA_FILES = {'TPM': 'stringtie_out/*TPM.tsv', 'FPKM': 'stringtie_out/*FPKM.tsv', 'RAWCOUNTS': 'rawcounts_output/*RAWCOUNTS.tsv'}
+# stringtie -A gene abundance file, with both the TPM and the FPKM of every gene
+ABUNDANCE_FILE = 'stringtie_out/*abund*.tab'
+DATA_TYPES = {'tpm': ['TPM'], 'fpkm': ['FPKM'], 'counts': ['RAWCOUNTS'], 'all': ['TPM', 'FPKM', 'RAWCOUNTS']}
+# Array type of each kind of data in --mode matrix
+MATRIX_DTYPES = {'TPM': 'float32', 'FPKM': 'float32', 'RAWCOUNTS': 'uint32'}
+# --normalise outputs made from the counts matrix (sizefactors is a table, <outFile>_sizeFactors.tsv)
+NORMALISATIONS = {'cpm': 'CPM', 'logcpm': 'logCPM', 'tpm': 'countsTPM', 'sizefactors': None}
+# --libraryStats: share of a library's total in its this many highest genes
+TOP_GENES = 50
+# --correlation methods
+CORRELATIONS = ('pearson', 'spearman')
+# MB the --correlation blocks may take without --maxMemory
+CORRELATION_MEMORY = 1024
+
+def scan_library_folders(libDirectory):
+    # The library output folders of a project by library ID (the part of the folder name before
+    # the first _, as in STEP 1), from one listing of the directory
+    libFolders = {}
+    for entry in sorted(os.scandir(libDirectory), key=lambda entry: entry.name):
+        if entry.is_dir():
+            libFolders.setdefault(entry.name.split("_")[0], []).append(entry.path)
+    return libFolders
+
+def library_files(libFolders, dataNames):
+    # The files of the kinds of data in dataNames (TPM, FPKM or RAWCOUNTS) in one library's output
+    # folders, matched as the join script globbed them, plus its stringtie gene abundance file as
+    # 'ABUNDANCE' if it has one, compressed (.gz, .zst) or not. Each output folder is listed once.
+    # Returns the matches of every kind of data, an empty list when there is none
+    listings = {}
+    matches = {}
+    for dataName in dataNames + ['ABUNDANCE']:
+        folder, pattern = (ABUNDANCE_FILE if dataName == 'ABUNDANCE' else DATA_FILES[dataName]).split('/')
+        matches[dataName] = []
+        for libFolder in libFolders:
+            outputFolder = os.path.join(libFolder, folder)
+            if outputFolder not in listings:
+                listings[outputFolder] = sorted(os.listdir(outputFolder)) if os.path.isdir(outputFolder) else []
+            for suffix in ('', '.gz', '.zst'):
+                matches[dataName] += [os.path.join(outputFolder, fileName) for fileName in fnmatch.filter(listings[outputFolder], pattern + suffix)]
+    return matches
+
+def resolve_library_files(libDirectory, libIDs, dataNames):
+    # The file of every kind of data for every library, from a single scan of the project.
+    # Libraries with several matching files (the first is used) and missing files are all
+    # reported before anything is joined; missing files stop the run
+    libFolders = scan_library_folders(libDirectory)
+    libFiles = {}
+    missing = []
+    for libID in libIDs:
+        libFiles[libID] = {}
+        for dataName, matches in library_files(libFolders.get(libID, []), dataNames).items():
+            if len(matches) > 1:
+                print("\tWARNING: " + str(len(matches)) + " " + dataName + " files for library " + libID + ", using " + matches[0])
+                for match in matches[1:]:
+                    print("\t\tnot " + match)
+            if matches:
+                libFiles[libID][dataName] = matches[0]
+            elif dataName != 'ABUNDANCE':
+                missing.append("no " + DATA_FILES[dataName] + " file for library " + libID)
+    if missing:
+        print("\nERROR: " + "\nERROR: ".join(missing))
+        exit()
+    return libFiles
+
+def write_manifest(manifestPath, libFiles, libIDs, dataNames):
+    # The resolved file of every kind of data for every library, one library per row
+    columns = dataNames + ['ABUNDANCE']
+    with open(manifestPath, 'w') as manifestFile:
+        manifestFile.write('\t'.join(['LibraryID'] + columns) + '\n')
+        for libID in libIDs:
+            manifestFile.write('\t'.join([libID] + [libFiles[libID].get(column, '') for column in columns]) + '\n')
+
+def read_manifest(manifestPath, libIDs, dataNames):
+    # The library files recorded by write_manifest; stops if a library or kind of data is missing
+    libFiles = {}
+    with open(manifestPath, 'r') as manifestFile:
+        header = manifestFile.readline().rstrip('\n').split('\t')
+        for line in manifestFile:
+            fields = line.rstrip('\n').split('\t')
+            libFiles[fields[0]] = {column: path for column, path in zip(header[1:], fields[1:]) if path}
+    missing = [libID + " " + dataName for libID in libIDs for dataName in dataNames if dataName not in libFiles.get(libID, {})]
+    if missing:
+        print("\nERROR: " + manifestPath + " has no file for " + ", ".join(missing) + "; run without --manifest to scan the project again")
+        exit()
+    return libFiles
+
+def script_path(path):
+    # A library file as the join script reads it: quoted, and decompressed on the fly if compressed
+    compression = compressed_io.file_compression(path)
+    if compression != 'none':
+        return "<(" + compression + " -dc " + shlex.quote(path) + ")"
+    return shlex.quote(path)
+
+def abundance_usable(libFiles, libIDs, dataNames):
+    # Whether TPM and FPKM can be read together from the stringtie gene abundance files (--abundance):
+    # every library needs one, and the first library's must hold the same gene IDs as its TPM and
+    # FPKM files (not so if those are transcript level). Says why not, if not
+    if not ('TPM' in dataNames and 'FPKM' in dataNames):
+        return False
+    missing = [i for i in libIDs if 'ABUNDANCE' not in libFiles[i]]
+    if missing:
+        print("\tWARNING: no " + ABUNDANCE_FILE + " file for " + ", ".join(missing) + ", reading " + DATA_FILES['TPM'] + " and " + DATA_FILES['FPKM'] + " instead")
+        return False
+    abundanceGenes = set(read_library((libFiles[libIDs[0]]['ABUNDANCE'], ['TPM']))[0])
+    for dataName in ('TPM', 'FPKM'):
+        if set(read_library(libFiles[libIDs[0]][dataName])[0]) != abundanceGenes:
+            print("\tWARNING: " + libFiles[libIDs[0]]['ABUNDANCE'] + " does not have the genes of " + libFiles[libIDs[0]][dataName] + ", reading " + DATA_FILES['TPM'] + " and " + DATA_FILES['FPKM'] + " instead")
+            return False
+    return True
+
+def read_passes(libFiles, libIDs, dataNames, useAbundance):
+    # How to read dataNames: (dataNames, source of each library) pairs, sources as read_library
+    # takes them. TPM and FPKM come from the same stringtie run, so with useAbundance (checked
+    # with abundance_usable) both are read together from each library's gene abundance file
+    passes = []
+    if useAbundance:
+        passes.append((['TPM', 'FPKM'], {i: (libFiles[i]['ABUNDANCE'], ['TPM', 'FPKM']) for i in libIDs}))
+        dataNames = [dataName for dataName in dataNames if dataName not in ('TPM', 'FPKM')]
+    passes += [([dataName], {i: libFiles[i][dataName] for i in libIDs}) for dataName in dataNames]
+    return passes
+
+def select_source(source, dataNames):
+    # The source of only the kinds of data in dataNames, out of those a source reads
+    return source if isinstance(source, str) else (source[0], dataNames)
+
+def raise_open_file_limit(nFiles):
+    # A merge join keeps every input open at once; raise the soft limit on open files if that needs it
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < nFiles + 32:
+        if hard == resource.RLIM_INFINITY:
+            hard = nFiles + 32
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(nFiles + 32, hard), hard))
+
+def next_row(inFile, inPath, previousKey):
+    # The next row of a join input, split on blanks like join does; None at the end of the file.
+    # Stops with an error if the keys are not strictly increasing
+    for line in inFile:
+        fields = line.split()
+        if not fields:
+            continue
+        if previousKey is not None and fields[0] <= previousKey:
+            print("\nERROR: " + inPath + " is not sorted on the gene ID (or repeats one): " + fields[0] + " after " + previousKey)
+            print("\tSort it with: LC_ALL=C sort -k1,1 " + inPath)
+            exit(1)
+        return fields
+    return None
+
+def hash_genes(geneIDs):
+    # Fingerprint of a gene-ID column: the same genes in the same order give the same hash
+    digest = hashlib.blake2b(digest_size=16)
+    for geneID in geneIDs:
+        digest.update(geneID.encode() + b'\n')
+    return digest.hexdigest()
+
+def gene_fingerprint(inPath, hasHeader=False):
+    # Fingerprint of the gene IDs (first field of every non-blank row) of one file,
+    # leaving out the header row of a joined table
+    with compressed_io.open_input(inPath) as inFile:
+        if hasHeader:
+            inFile.readline()
+        return hash_genes(fields[0] for fields in (line.split(None, 1) for line in inFile) if fields)
+
+def split_by_fingerprint(inPaths, libIDs, tableFirst=False):
+    # Indexes of the files with the same gene-ID column as the first file, and of those without
+    # (reported, as they have to be joined by gene ID). With tableFirst the first file is an
+    # existing joined table (--append), with a header row
+    fingerprints = [gene_fingerprint(inPath, tableFirst and i == 0) for i, inPath in enumerate(inPaths)]
+    same = [i for i, fingerprint in enumerate(fingerprints) if fingerprint == fingerprints[0]]
+    different = [i for i, fingerprint in enumerate(fingerprints) if fingerprint != fingerprints[0]]
+    for i in different:
+        print("\tWARNING: " + libIDs[i] + " does not have the same genes in the same order as " + libIDs[0] + ", joining it by gene ID")
+    return same, different
+
+def read_library(source):
+    # Gene IDs and values of one library's file, with one list of values per value column.
+    # source is either a path, values in the column after the ID, split on blanks like join,
+    # or (path, column names) for a tab-separated file with a header row, such as a stringtie
+    # gene abundance file. Files may be gzip or zstd compressed
+    geneIDs = []
+    if isinstance(source, str):
+        values = [[]]
+        with compressed_io.open_input(source) as inFile:
+            for line in inFile:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                geneIDs.append(fields[0])
+                values[0].append(fields[1])
+        return geneIDs, values
+    inPath, names = source
+    values = [[] for name in names]
+    with compressed_io.open_input(inPath) as inFile:
+        header = inFile.readline().rstrip('\n').split('\t')
+        columns = [header.index(name) for name in names]
+        for line in inFile:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) <= max(columns):
+                continue
+            geneIDs.append(fields[0])
+            for k, column in enumerate(columns):
+                values[k].append(fields[column])
+    return geneIDs, values
+
+def reference_genes(geneIDs):
+    # The reference gene order of a matrix (its first library's, or an existing matrix's
+    # .genes.txt), with its fingerprint and the row of each gene
+    return {'geneIDs': geneIDs, 'fingerprint': hash_genes(geneIDs),
+            'index': {geneID: i for i, geneID in enumerate(geneIDs)}}
+
+def read_gene_map(mapPath):
+    # Gene ID of each transcript ID from a transcript-to-gene map: transcript ID and gene ID
+    # columns split on blanks, lines starting with # skipped
+    geneMap = {}
+    with compressed_io.open_input(mapPath) as mapFile:
+        for line in mapFile:
+            fields = line.split()
+            if len(fields) < 2 or fields[0].startswith('#'):
+                continue
+            geneMap[fields[0]] = fields[1]
+    return geneMap
+
+def map_transcripts(reference, geneMap):
+    # Have a reference sum transcripts into its genes (--geneMap): every transcript is interned
+    # as the integer row of its gene, and the rows of each library file's transcripts are worked
+    # out once per transcript order (by fingerprint), then reused for every library that shares it
+    reference['transcriptRows'] = {transcriptID: reference['index'][geneID] for transcriptID, geneID in geneMap.items() if geneID in reference['index']}
+    reference['rowsByFingerprint'] = {}
+    return reference
+
+def gene_map_reference(geneMap):
+    # Reference of a new gene-level matrix: the map's genes, in the order they first appear in it
+    return map_transcripts(reference_genes(list(dict.fromkeys(geneMap.values()))), geneMap)
+
+def gene_columns(libGenes, values, libID, reference):
+    # One library's transcript values summed into the reference genes (float64, one array per
+    # value column): a bincount over the transcripts' gene rows. Transcripts not in the map are
+    # dropped, reported once for each transcript order
+    fingerprint = hash_genes(libGenes)
+    if fingerprint not in reference['rowsByFingerprint']:
+        rows = np.array([reference['transcriptRows'].get(transcriptID, -1) for transcriptID in libGenes], dtype=np.int64)
+        found = rows >= 0
+        if not found.all():
+            print("\tWARNING: " + str(int((~found).sum())) + " transcripts of " + libID + " are not in the gene map (dropped; not reported again for libraries with the same transcripts)")
+        reference['rowsByFingerprint'][fingerprint] = (rows[found], found)
+    rows, found = reference['rowsByFingerprint'][fingerprint]
+    return [np.bincount(rows, weights=np.asarray(columnValues, dtype=np.float64)[found], minlength=len(reference['geneIDs']))
+            for columnValues in values]
+
+def new_reference(sources, geneMap=None):
+    # Reference gene order of a new matrix: its first library's, or the genes of geneMap
+    if geneMap is not None:
+        return gene_map_reference(geneMap)
+    return reference_genes(read_library(sources[0])[0])
+
+def library_columns(source, libID, refID, reference):
+    # One library's values (float64, one array per value column) in the reference gene order.
+    # A library with the same fingerprint is taken as is; any other is placed by gene ID, genes
+    # it lacks are left at 0 and genes not in the reference are dropped, all reported.
+    # With a gene map (map_transcripts) its transcripts are summed into genes instead
+    libGenes, values = read_library(source)
+    if 'transcriptRows' in reference:
+        return gene_columns(libGenes, values, libID, reference)
+    if hash_genes(libGenes) == reference['fingerprint']:
+        return [np.asarray(columnValues, dtype=np.float64) for columnValues in values]
+    print("\tWARNING: " + libID + " does not have the same genes in the same order as " + refID + ", placing it by gene ID")
+    rows = np.array([reference['index'].get(geneID, -1) for geneID in libGenes], dtype=np.int64)
+    found = rows >= 0
+    columns = []
+    for columnValues in values:
+        column = np.zeros(len(reference['geneIDs']))
+        column[rows[found]] = np.asarray(columnValues, dtype=np.float64)[found]
+        columns.append(column)
+    nMissing = len(reference['geneIDs']) - len(np.unique(rows[found]))
+    if nMissing or not found.all():
+        print("\tWARNING: " + libID + " lacks " + str(nMissing) + " genes (left at 0) and has " + str(int((~found).sum())) + " genes not in " + refID + " (dropped)")
+    return columns
+
+def read_gene_list(listPath):
+    # Gene IDs in a file, the first field of each line
+    with compressed_io.open_input(listPath) as listFile:
+        return set(line.split()[0] for line in listFile if line.split())
+
+def new_library_stats(threshold, geneSets):
+    # Accumulator of --libraryStats, filled by add_library_stats as each library column is built:
+    # geneSets are (name, set of gene IDs) whose share of every library's total is reported
+    return {'threshold': threshold, 'geneSets': geneSets, 'setRows': {}, 'columns': [], 'rows': {}}
+
+def add_library_stats(stats, reference, libID, dataName, column):
+    # The statistics of one library column (in the reference gene order): total, genes above the
+    # threshold, share of the total in the TOP_GENES highest genes and in each gene set
+    if reference['fingerprint'] not in stats['setRows']:
+        stats['setRows'][reference['fingerprint']] = [np.array([reference['index'][geneID] for geneID in genes if geneID in reference['index']], dtype=np.int64)
+                                                      for name, genes in stats['geneSets']]
+    total = column.sum()
+    top = np.partition(column, len(column) - TOP_GENES)[-TOP_GENES:] if len(column) > TOP_GENES else column
+    values = [('Total', total), ('Detected', int((column > stats['threshold']).sum())), ('Top' + str(TOP_GENES) + 'Fraction', top.sum())]
+    values += [(name + 'Fraction', column[rows].sum()) for (name, genes), rows in zip(stats['geneSets'], stats['setRows'][reference['fingerprint']])]
+    row = stats['rows'].setdefault(libID, {})
+    for metric, value in values:
+        name = dataName + '_' + metric
+        if name not in stats['columns']:
+            stats['columns'].append(name)
+        row[name] = value / total if metric.endswith('Fraction') and total else (np.nan if metric.endswith('Fraction') else value)
+
+def write_library_stats(statsPath, stats, libIDs, append=False):
+    # The libraries x statistics table, one row per library of libIDs. With append, rows and
+    # columns already in the table are kept, and updated for the libraries just read
+    columns, rows = list(stats['columns']), {}
+    if append and os.path.exists(statsPath):
+        with open(statsPath, 'r') as statsFile:
+            oldColumns = statsFile.readline().rstrip('\n').split('\t')[1:]
+            for line in statsFile:
+                fields = line.rstrip('\n').split('\t')
+                rows[fields[0]] = dict(zip(oldColumns, fields[1:]))
+        columns = oldColumns + [name for name in columns if name not in oldColumns]
+    for libID, row in stats['rows'].items():
+        rows.setdefault(libID, {}).update(row)
+    libIDs = [libID for libID in rows if libID not in libIDs] + list(libIDs)
+    with open(statsPath + '.tmp', 'w') as statsFile:
+        statsFile.write('\t'.join(['Library'] + columns) + '\n')
+        for libID in libIDs:
+            values = [rows.get(libID, {}).get(name, 'NA') for name in columns]
+            statsFile.write('\t'.join([libID] + [value if isinstance(value, str) else '%.10g' % value for value in values]) + '\n')
+    os.replace(statsPath + '.tmp', statsPath)
+
+def build_matrix(sources, libIDs, dataNames, reference=None, refID=None, geneMap=None, stats=None):
+    # Load every library's values into one preallocated genes x libraries array per kind of data
+    # in dataNames (float32, or uint32 for RAWCOUNTS), reading each library's source once, in
+    # the gene order of the first library (or of geneMap's genes) unless a reference is given.
+    # Stored column by column (Fortran order), so each library is one contiguous block and
+    # --append can add libraries to the end of the .npy file. Library statistics are added to
+    # stats (new_library_stats), if given, as each column is placed
+    if reference is None:
+        reference, refID = new_reference(sources, geneMap), libIDs[0]
+    matrices = [np.zeros((len(reference['geneIDs']), len(sources)), dtype=MATRIX_DTYPES[dataName], order='F') for dataName in dataNames]
+    for j, source in enumerate(sources):
+        for k, column in enumerate(library_columns(source, libIDs[j], refID, reference)):
+            matrices[k][:, j] = column
+            if stats is not None:
+                add_library_stats(stats, reference, libIDs[j], dataNames[k], column)
+    return matrices, reference['geneIDs']
+
+def build_sparse(sources, libIDs, dataNames, reference=None, refID=None, geneMap=None, stats=None):
+    # The same genes x libraries matrices in compressed sparse column (CSC) form, built one
+    # library at a time so only the non-zero values are ever held: indptr, indices (gene rows)
+    # and data, as scipy.sparse.csc_matrix((data, indices, indptr), shape) takes them
+    if reference is None:
+        reference, refID = new_reference(sources, geneMap), libIDs[0]
+    indptr = [[0] for dataName in dataNames]
+    indices = [[] for dataName in dataNames]
+    data = [[] for dataName in dataNames]
+    for j, source in enumerate(sources):
+        for k, column in enumerate(library_columns(source, libIDs[j], refID, reference)):
+            if stats is not None:
+                add_library_stats(stats, reference, libIDs[j], dataNames[k], column)
+            nonZero = np.flatnonzero(column)
+            indices[k].append(nonZero.astype(np.int32))
+            data[k].append(column[nonZero].astype(MATRIX_DTYPES[dataNames[k]]))
+            indptr[k].append(indptr[k][-1] + len(nonZero))
+    sparse = [{'indptr': np.array(indptr[k], dtype=np.int64), 'indices': np.concatenate(indices[k]),
+               'data': np.concatenate(data[k]), 'shape': (len(reference['geneIDs']), len(sources))} for k in range(len(dataNames))]
+    return sparse, reference['geneIDs']
+
+def save_labels(outBase, geneIDs, libIDs):
+    # Row and column labels of a matrix in <outBase>.genes.txt and <outBase>.libraries.txt, one per line
+    with open(outBase + '.genes.txt', 'w') as genesFile:
+        genesFile.write('\n'.join(geneIDs) + '\n')
+    with open(outBase + '.libraries.txt', 'w') as libsFile:
+        libsFile.write('\n'.join(libIDs) + '\n')
+
+def save_matrix(outBase, matrix, geneIDs, libIDs):
+    # <outBase>.npy, ready for np.load(mmap_mode='r'), with its labels
+    np.save(outBase + '.npy', matrix)
+    save_labels(outBase, geneIDs, libIDs)
+
+def write_npz(npzPath, arrays):
+    # (name, array) pairs into a compressed .npz laid out as np.savez_compressed does, each
+    # array written in chunks, so memory-mapped shards are streamed from disk, not loaded
+    with zipfile.ZipFile(npzPath + '.tmp', 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as npzFile:
+        for name, array in arrays:
+            with npzFile.open(name + '.npy', 'w', force_zip64=True) as member:
+                np.lib.format.write_array(member, np.asanyarray(array), allow_pickle=False)
+    os.replace(npzPath + '.tmp', npzPath)
+
+def write_mtx_entries(mtxFile, sparse, firstColumn=0):
+    # Matrix Market lines (1-based gene row, library column, value) of CSC columns, one column at a time.
+    # Counts are written as integers, float32 values with the 7 significant digits they hold
+    valueFormat = '%d %d %d\n' if sparse['data'].dtype.kind in 'iu' else '%d %d %.7g\n'
+    for j in range(len(sparse['indptr']) - 1):
+        start, end = sparse['indptr'][j], sparse['indptr'][j + 1]
+        for row, value in zip(sparse['indices'][start:end].tolist(), sparse['data'][start:end].tolist()):
+            mtxFile.write(valueFormat % (row + 1, firstColumn + j + 1, value))
+
+def save_sparse(outBase, sparse, geneIDs, libIDs, sparseFormat, compression='none', threads=1):
+    # npz: <outBase>.npz in the layout of scipy.sparse.save_npz, so scipy.sparse.load_npz reads it
+    #   (or build it from the indptr, indices and data arrays with NumPy alone)
+    # mtx: <outBase>.mtx, Matrix Market coordinate format (1-based gene row, library column, value),
+    #   compressed as it is written with --compress (<outBase>.mtx.gz)
+    if sparseFormat == 'npz':
+        write_npz(outBase + '.npz', [('format', np.array(b'csc')), ('shape', np.array(sparse['shape'])),
+                  ('indptr', sparse['indptr']), ('indices', sparse['indices']), ('data', sparse['data'])])
+    else:
+        field = 'integer' if sparse['data'].dtype.kind in 'iu' else 'real'
+        mtxPath = compressed_io.output_name(outBase + '.mtx', compression)
+        with compressed_io.open_output(mtxPath + '.tmp', 'w', compression, threads) as mtxFile:
+            mtxFile.write('%%MatrixMarket matrix coordinate ' + field + ' general\n')
+            mtxFile.write('%d %d %d\n' % (sparse['shape'][0], sparse['shape'][1], len(sparse['data'])))
+            write_mtx_entries(mtxFile, sparse)
+        os.replace(mtxPath + '.tmp', mtxPath)
+    save_labels(outBase, geneIDs, libIDs)
+
+def block_width(nGenes, dataName, maxMemory):
+    # Libraries per block for --maxMemory (MB): what fits once the columns being parsed and
+    # placed (about 200 bytes a gene) are set aside
+    itemSize = np.dtype(MATRIX_DTYPES[dataName]).itemsize
+    return max(1, int((maxMemory * 2**20 - nGenes * 200) // (nGenes * itemSize)))
+
+def read_shard(shardPath, dtype):
+    # A spilled block as a read-only memory-mapped array (mmap cannot map an empty file)
+    if os.path.getsize(shardPath) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(shardPath, dtype=dtype, mode='r')
+
+def blocked_width(nGenes, dataNames, maxMemory):
+    # Libraries per block when the kinds of data in dataNames are built together within --maxMemory
+    return max(1, min(block_width(nGenes, dataName, maxMemory) for dataName in dataNames) // len(dataNames))
+
+def write_blocked_matrix(sources, libIDs, dataNames, outBases, maxMemory, geneMap=None, stats=None):
+    # --mode matrix within --maxMemory MB: libraries are loaded a column block at a time and
+    # each block is written out before the next is built. As the .npy is column-ordered every
+    # block is simply the next stretch of the file, so the blocks go straight into it in one
+    # sequential write each, with no separate stitching pass. Every kind of data in dataNames
+    # is built from the same read of each library, into its own <outBase>.npy
+    reference = new_reference(sources, geneMap)
+    nGenes = len(reference['geneIDs'])
+    width = blocked_width(nGenes, dataNames, maxMemory)
+    print("\t" + str(width) + " libraries per block")
+    npyFiles = []
+    try:
+        for dataName, outBase in zip(dataNames, outBases):
+            npyFiles.append(open(outBase + '.npy.tmp', 'wb'))
+            np.lib.format.write_array_header_1_0(npyFiles[-1], {'descr': np.lib.format.dtype_to_descr(np.dtype(MATRIX_DTYPES[dataName])),
+                                                                'fortran_order': True, 'shape': (nGenes, len(sources))})
+        for start in range(0, len(sources), width):
+            blocks, geneIDs = build_matrix(sources[start:start + width], libIDs[start:start + width], dataNames, reference, libIDs[0], stats=stats)
+            for npyFile, block in zip(npyFiles, blocks):
+                npyFile.write(block.T.tobytes())
+    except BaseException:
+        for npyFile in npyFiles:
+            npyFile.close()
+            os.remove(npyFile.name)
+        raise
+    for npyFile, outBase in zip(npyFiles, outBases):
+        npyFile.close()
+        os.replace(outBase + '.npy.tmp', outBase + '.npy')
+        save_labels(outBase, reference['geneIDs'], libIDs)
+    return (nGenes, len(sources))
+
+def write_blocked_sparse(sources, libIDs, dataNames, outBases, sparseFormat, maxMemory, compression='none', threads=1, geneMap=None, stats=None):
+    # --mode sparse within --maxMemory MB: the CSC indices and values of each column block are
+    # spilled to two temporary binary shards per kind of data in dataNames, next to the output
+    # (only indptr, one number per library, stays in memory), then the shards are streamed into
+    # each <outBase>.npz or .mtx. Returns the shape and the number of values of each
+    reference = new_reference(sources, geneMap)
+    nGenes = len(reference['geneIDs'])
+    width = blocked_width(nGenes, dataNames, maxMemory)
+    print("\t" + str(width) + " libraries per block")
+    shardDir = tempfile.mkdtemp(prefix='.' + os.path.basename(outBases[0]) + '.', dir=os.path.dirname(os.path.abspath(outBases[0])))
+    nValues = []
+    try:
+        indptr = [[np.zeros(1, dtype=np.int64)] for dataName in dataNames]
+        shardFiles = [(open(os.path.join(shardDir, 'indices' + str(k)), 'wb'), open(os.path.join(shardDir, 'data' + str(k)), 'wb')) for k in range(len(dataNames))]
+        try:
+            for start in range(0, len(sources), width):
+                blocks, geneIDs = build_sparse(sources[start:start + width], libIDs[start:start + width], dataNames, reference, libIDs[0], stats=stats)
+                for k, block in enumerate(blocks):
+                    indptr[k].append(block['indptr'][1:] + indptr[k][-1][-1])
+                    shardFiles[k][0].write(block['indices'].tobytes())
+                    shardFiles[k][1].write(block['data'].tobytes())
+        finally:
+            for indicesFile, dataFile in shardFiles:
+                indicesFile.close()
+                dataFile.close()
+        for k, (dataName, outBase) in enumerate(zip(dataNames, outBases)):
+            sparse = {'indptr': np.concatenate(indptr[k]), 'indices': read_shard(os.path.join(shardDir, 'indices' + str(k)), np.int32),
+                      'data': read_shard(os.path.join(shardDir, 'data' + str(k)), MATRIX_DTYPES[dataName]), 'shape': (nGenes, len(sources))}
+            save_sparse(outBase, sparse, reference['geneIDs'], libIDs, sparseFormat, compression, threads)
+            nValues.append(len(sparse['data']))
+            del sparse
+    finally:
+        shutil.rmtree(shardDir)
+    return (nGenes, len(sources)), nValues
+
+def read_labels(outBase):
+    # Gene IDs and library IDs of a matrix written by save_labels
+    with open(outBase + '.genes.txt', 'r') as genesFile:
+        geneIDs = genesFile.read().split()
+    with open(outBase + '.libraries.txt', 'r') as libsFile:
+        libIDs = libsFile.read().split()
+    return geneIDs, libIDs
+
+def append_matrix(outBases, sources, newLibs, dataNames, geneMap=None, stats=None):
+    # Add the libraries newLibs (read from sources, once for every kind of data in dataNames) as
+    # new columns of each <outBase>.npy, which must all have the same genes, placed in their gene
+    # order. Returns the shape of each and whether it was appended to in place
+    geneIDs = read_labels(outBases[0])[0]
+    reference = reference_genes(geneIDs) if geneMap is None else map_transcripts(reference_genes(geneIDs), geneMap)
+    matrices, geneIDs = build_matrix(sources, newLibs, dataNames, reference, outBases[0], stats=stats)
+    return [append_columns(outBase, columns, newLibs) for outBase, columns in zip(outBases, matrices)]
+
+def append_columns(outBase, columns, newLibs):
+    # Add columns (genes x newLibs, in its gene order) to <outBase>.npy. A column-ordered file only
+    # needs the new columns written at its end and the shape in its header updated, so the cost
+    # is that of the new libraries; any other .npy (row ordered, or with no room left in its
+    # header) is rewritten
+    geneIDs, libIDs = read_labels(outBase)
+    with open(outBase + '.npy', 'r+b') as npyFile:
+        version = np.lib.format.read_magic(npyFile)
+        headerStart = npyFile.tell()
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(npyFile)
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(npyFile)
+        dataStart = npyFile.tell()
+        if shape != (len(geneIDs), len(libIDs)) or dtype != columns.dtype:
+            print("\nERROR: " + outBase + ".npy does not match its .genes.txt and .libraries.txt, or is not " + str(columns.dtype) + "; rebuild it without --append")
+            exit(1)
+        header = "{'descr': %r, 'fortran_order': True, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), (shape[0], shape[1] + len(newLibs)))
+        lengthBytes = 2 if version == (1, 0) else 4
+        headerSpace = dataStart - headerStart - lengthBytes
+        if fortranOrder and len(header) < headerSpace:
+            # New columns first, then the header, so an interrupted append leaves the old matrix readable
+            npyFile.seek(dataStart + shape[0] * shape[1] * dtype.itemsize)
+            npyFile.write(columns.tobytes(order='F'))
+            npyFile.truncate()
+            npyFile.seek(headerStart + lengthBytes)
+            npyFile.write((header.ljust(headerSpace - 1) + '\n').encode('latin1'))
+            inPlace = True
+        else:
+            inPlace = False
+    if not inPlace:
+        matrix = np.asfortranarray(np.hstack([np.load(outBase + '.npy'), columns]))
+        with open(outBase + '.npy.tmp', 'wb') as npyFile:
+            np.save(npyFile, matrix)
+        os.replace(outBase + '.npy.tmp', outBase + '.npy')
+    save_labels(outBase, geneIDs, libIDs + newLibs)
+    return (len(geneIDs), len(libIDs) + len(newLibs)), inPlace
+
+def append_sparse(outBases, sources, newLibs, dataNames, sparseFormat, compression='none', threads=1, geneMap=None, stats=None):
+    # Add the libraries newLibs (read once for every kind of data in dataNames) as new columns of
+    # each <outBase>.npz or .mtx, which must all have the same genes. Returns the shape and the
+    # number of values of each
+    geneIDs = read_labels(outBases[0])[0]
+    reference = reference_genes(geneIDs) if geneMap is None else map_transcripts(reference_genes(geneIDs), geneMap)
+    newMatrices, geneIDs = build_sparse(sources, newLibs, dataNames, reference, outBases[0], stats=stats)
+    return [append_sparse_columns(outBase, new, newLibs, sparseFormat, compression, threads) for outBase, new in zip(outBases, newMatrices)]
+
+def append_sparse_columns(outBase, new, newLibs, sparseFormat, compression='none', threads=1):
+    # Add the CSC columns new to <outBase>.npz or .mtx. New columns of a CSC matrix are just more
+    # indices and data after the old ones, so the old values are copied through as they are,
+    # never rebuilt
+    geneIDs, libIDs = read_labels(outBase)
+    shape = (len(geneIDs), len(libIDs) + len(newLibs))
+    if sparseFormat == 'npz':
+        with np.load(outBase + '.npz') as old:
+            sparse = {'indptr': np.concatenate([old['indptr'], new['indptr'][1:] + old['indptr'][-1]]),
+                      'indices': np.concatenate([old['indices'], new['indices']]),
+                      'data': np.concatenate([old['data'], new['data'].astype(old['data'].dtype)]), 'shape': shape}
+        write_npz(outBase + '.npz', [('format', np.array(b'csc')), ('shape', np.array(shape)),
+                  ('indptr', sparse['indptr']), ('indices', sparse['indices']), ('data', sparse['data'])])
+        nValues = len(sparse['data'])
+    else:
+        mtxPath = compressed_io.output_name(outBase + '.mtx', compression)
+        with compressed_io.open_input(mtxPath) as oldFile, compressed_io.open_output(mtxPath + '.tmp', 'w', compression, threads) as mtxFile:
+            line = oldFile.readline()
+            while line.startswith('%'):
+                mtxFile.write(line)
+                line = oldFile.readline()
+            nValues = int(line.split()[2]) + len(new['data'])
+            mtxFile.write('%d %d %d\n' % (shape[0], shape[1], nValues))
+            for line in oldFile:
+                mtxFile.write(line)
+            write_mtx_entries(mtxFile, new, len(libIDs))
+        os.replace(mtxPath + '.tmp', mtxPath)
+    save_labels(outBase, geneIDs, libIDs + newLibs)
+    return shape, nValues
+
+def read_gene_lengths(lengthsPath):
+    # Gene lengths (bases) by gene ID: gene ID and length columns split on blanks, or a featureCounts
+    # table, whose Length column is used. Lines without a numeric length are skipped
+    lengths = {}
+    column = 1
+    with compressed_io.open_input(lengthsPath) as lengthsFile:
+        for line in lengthsFile:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if 'Length' in fields:
+                column = fields.index('Length')
+                continue
+            try:
+                lengths[fields[0]] = float(fields[column])
+            except (IndexError, ValueError):
+                continue
+    return lengths
+
+def normalise_block(counts, kind, lengths=None):
+    # One normalisation of a genes x libraries block of counts (float64), each library on its own:
+    # cpm = counts per million counts of the library, logcpm = log2(cpm + 1), tpm = counts per
+    # kilobase of gene length (lengths, 0 for genes without one), per million of the library's
+    # total per kilobase
+    if kind == 'tpm':
+        counts = np.divide(counts * 1e3, lengths[:, None], out=np.zeros_like(counts), where=lengths[:, None] > 0)
+    totals = counts.sum(axis=0)
+    scaled = counts * (1e6 / np.where(totals > 0, totals, 1))
+    if kind == 'logcpm':
+        return np.log2(scaled + 1)
+    return scaled
+
+def size_factors(count_block, nGenes, nLibs, width):
+    # Total counts and median-of-ratios size factor (as DESeq2 estimates them) of every library,
+    # from count_block(start, end), the genes x libraries counts of columns start to end as
+    # float64, read a block at a time. Genes with a zero count in any library are left out of
+    # the ratios; a size factor is nan if no gene is counted in every library
+    totals = np.zeros(nLibs)
+    logSums = np.zeros(nGenes)
+    inAll = np.ones(nGenes, dtype=bool)
+    for start in range(0, nLibs, width):
+        block = count_block(start, min(start + width, nLibs))
+        totals[start:start + block.shape[1]] = block.sum(axis=0)
+        inAll &= (block > 0).all(axis=1)
+        logSums[inAll] += np.log(block[inAll]).sum(axis=1)
+    factors = np.full(nLibs, np.nan)
+    if inAll.any():
+        logMeans = logSums[inAll] / nLibs
+        for start in range(0, nLibs, width):
+            block = count_block(start, min(start + width, nLibs))[inAll]
+            factors[start:start + block.shape[1]] = np.exp(np.median(np.log(block) - logMeans[:, None], axis=0))
+    return totals, factors
+
+def write_size_factors(outFile, libIDs, totals, factors):
+    # <outFile>_sizeFactors.tsv: total counts and size factor of every library
+    with open(outFile + '_sizeFactors.tsv', 'w') as factorsFile:
+        factorsFile.write('Library\tTotalCounts\tSizeFactor\n')
+        for libID, total, factor in zip(libIDs, totals, factors):
+            factorsFile.write(libID + '\t' + '%d' % total + '\t' + '%.6g' % factor + '\n')
+
+def gene_length_column(geneIDs, geneLengths):
+    # Gene lengths in matrix row order, 0 (and reported) for genes without one
+    lengths = np.array([geneLengths.get(geneID, 0) for geneID in geneIDs], dtype=np.float64)
+    if (lengths <= 0).any():
+        print("\tWARNING: " + str(int((lengths <= 0).sum())) + " genes have no length and are left out of the TPM")
+    return lengths
+
+def write_normalised_matrix(countsBase, outFile, kinds, geneLengths, maxMemory):
+    # Normalised copies of the counts in <countsBase>.npy (<outFile>_CPM.npy, _logCPM.npy,
+    # _countsTPM.npy, float32 with the same labels) and the size factors, computed with NumPy on
+    # the memory-mapped counts, a block of libraries at a time, and written in sequence
+    counts = np.load(countsBase + '.npy', mmap_mode='r')
+    geneIDs, libIDs = read_labels(countsBase)
+    nGenes, nLibs = counts.shape
+    # Float64 working copies of a block take about five times the space of its counts
+    width = max(1, block_width(nGenes, 'RAWCOUNTS', maxMemory) // 5) if maxMemory else nLibs
+    lengths = gene_length_column(geneIDs, geneLengths) if 'tpm' in kinds else None
+    count_block = lambda start, end: np.asarray(counts[:, start:end], dtype=np.float64)
+    outKinds = [kind for kind in kinds if NORMALISATIONS[kind]]
+    outFiles = {}
+    try:
+        for kind in outKinds:
+            outFiles[kind] = open(outFile + '_' + NORMALISATIONS[kind] + '.npy.tmp', 'wb')
+            np.lib.format.write_array_header_1_0(outFiles[kind], {'descr': np.lib.format.dtype_to_descr(np.dtype('float32')),
+                                                                  'fortran_order': True, 'shape': (nGenes, nLibs)})
+        for start in range(0, nLibs if outKinds else 0, width):
+            block = count_block(start, min(start + width, nLibs))
+            for kind in outKinds:
+                outFiles[kind].write(normalise_block(block, kind, lengths).astype(np.float32).T.tobytes())
+    finally:
+        for outFile_ in outFiles.values():
+            outFile_.close()
+    for kind in outKinds:
+        os.replace(outFile + '_' + NORMALISATIONS[kind] + '.npy.tmp', outFile + '_' + NORMALISATIONS[kind] + '.npy')
+        save_labels(outFile + '_' + NORMALISATIONS[kind], geneIDs, libIDs)
+    if 'sizefactors' in kinds:
+        write_size_factors(outFile, libIDs, *size_factors(count_block, nGenes, nLibs, width))
+    return [outFile + '_' + NORMALISATIONS[kind] + '.npy' for kind in outKinds]
+
+def write_normalised_sparse(countsBase, outFile, kinds, geneLengths, maxMemory):
+    # The same for the counts in <countsBase>.npz: normalised values are computed on the non-zero
+    # counts only and written as .npz with the same sparsity (log2(0 + 1) is still 0). The counts
+    # are streamed a block of libraries at a time, as for the matrix, and the normalised values
+    # spilled to temporary files until the .npz are written
+    shape, indptr, read_columns = sparse_column_reader(countsBase + '.npz')
+    geneIDs, libIDs = read_labels(countsBase)
+    nGenes, nLibs = shape
+    width = max(1, block_width(nGenes, 'RAWCOUNTS', maxMemory) // 5) if maxMemory else nLibs
+    lengths = gene_length_column(geneIDs, geneLengths) if 'tpm' in kinds else None
+    outKinds = [kind for kind in kinds if NORMALISATIONS[kind]]
+    shardDir = tempfile.mkdtemp(prefix='.' + os.path.basename(outFile) + '.', dir=os.path.dirname(os.path.abspath(outFile)))
+    try:
+        shardFiles = [open(os.path.join(shardDir, name), 'wb') for name in ['indices'] + outKinds]
+        try:
+            for start in range(0, nLibs if outKinds else 0, width):
+                end = min(start + width, nLibs)
+                indices, data = read_columns(start, end)
+                libraryOf = np.repeat(np.arange(end - start), np.diff(indptr[start:end + 1]))
+                values = data.astype(np.float64)
+                shardFiles[0].write(indices.astype(np.int32).tobytes())
+                for kind, shardFile in zip(outKinds, shardFiles[1:]):
+                    kindValues = values
+                    if kind == 'tpm':
+                        geneLengthOf = lengths[indices]
+                        kindValues = np.divide(values * 1e3, geneLengthOf, out=np.zeros_like(values), where=geneLengthOf > 0)
+                    totals = np.bincount(libraryOf, weights=kindValues, minlength=end - start)
+                    scaled = kindValues * (1e6 / np.where(totals > 0, totals, 1))[libraryOf]
+                    if kind == 'logcpm':
+                        scaled = np.log2(scaled + 1)
+                    shardFile.write(scaled.astype(np.float32).tobytes())
+        finally:
+            for shardFile in shardFiles:
+                shardFile.close()
+        for kind in outKinds:
+            write_npz(outFile + '_' + NORMALISATIONS[kind] + '.npz', [('format', np.array(b'csc')), ('shape', np.array(shape)), ('indptr', indptr),
+                      ('indices', read_shard(os.path.join(shardDir, 'indices'), np.int32)), ('data', read_shard(os.path.join(shardDir, kind), np.float32))])
+            save_labels(outFile + '_' + NORMALISATIONS[kind], geneIDs, libIDs)
+    finally:
+        shutil.rmtree(shardDir)
+    if 'sizefactors' in kinds:
+        write_size_factors(outFile, libIDs, *size_factors(sparse_column_block(nGenes, indptr, read_columns), nGenes, nLibs, width))
+    return [outFile + '_' + NORMALISATIONS[kind] + '.npz' for kind in outKinds]
+
+def sparse_column_reader(npzPath):
+    # (shape, indptr, read_columns) of a CSC .npz written here, where read_columns(start, end)
+    # gives the row indices and values of columns start to end. Both are streamed from the zip in
+    # column order (asking for earlier columns reopens it), so only the columns asked for are
+    # held in memory; the file is closed again once the last column has been read
+    with np.load(npzPath) as npz:
+        shape = tuple(int(n) for n in npz['shape'])
+        indptr = npz['indptr'].astype(np.int64)
+    state = {'npzFile': None, 'members': [], 'position': 0}
+    def close():
+        if state['npzFile'] is not None:
+            for member, dtype in state['members']:
+                member.close()
+            state['npzFile'].close()
+        state['npzFile'], state['members'], state['position'] = None, [], 0
+    def read_columns(start, end):
+        first, last = int(indptr[start]), int(indptr[end])
+        if state['npzFile'] is None or first < state['position']:
+            close()
+            state['npzFile'] = zipfile.ZipFile(npzPath)
+            for name in ('indices', 'data'):
+                member = state['npzFile'].open(name + '.npy')
+                version = np.lib.format.read_magic(member)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                state['members'].append((member, read_header(member)[2]))
+        arrays = []
+        for member, dtype in state['members']:
+            member.seek((first - state['position']) * dtype.itemsize, os.SEEK_CUR)
+            arrays.append(np.frombuffer(member.read((last - first) * dtype.itemsize), dtype=dtype))
+        state['position'] = last
+        if end == shape[1]:
+            close()
+        return arrays[0], arrays[1]
+    return shape, indptr, read_columns
+
+def sparse_column_block(nGenes, indptr, read_columns):
+    # column_block(start, end): the columns start to end of a CSC matrix, dense, as float64
+    def column_block(start, end):
+        indices, data = read_columns(start, end)
+        block = np.zeros((nGenes, end - start))
+        block[indices, np.repeat(np.arange(end - start), np.diff(indptr[start:end + 1]))] = data
+        return block
+    return column_block
+
+def matrix_column_block(outBase, isSparse=False):
+    # (nGenes, nLibs, column_block) of a matrix written here, <outBase>.npy memory-mapped or
+    # <outBase>.npz streamed, where column_block(start, end) gives its columns start to end as
+    # float64, asked for in column order
+    if isSparse:
+        shape, indptr, read_columns = sparse_column_reader(outBase + '.npz')
+        return shape[0], shape[1], sparse_column_block(shape[0], indptr, read_columns)
+    matrix = np.load(outBase + '.npy', mmap_mode='r')
+    return matrix.shape[0], matrix.shape[1], lambda start, end: np.asarray(matrix[:, start:end], dtype=np.float64)
+
+def rank_columns(block):
+    # Ranks of the values of each column (1 = lowest), ties sharing their average rank
+    order = np.argsort(block, axis=0, kind='stable')
+    sortedBlock = np.take_along_axis(block, order, axis=0)
+    ranks = np.empty_like(block)
+    for j in range(block.shape[1]):
+        starts = np.flatnonzero(np.r_[True, sortedBlock[1:, j] != sortedBlock[:-1, j]])
+        ends = np.r_[starts[1:], block.shape[0]]
+        ranks[order[:, j], j] = np.repeat((starts + ends + 1) / 2.0, ends - starts)
+    return ranks
+
+def standardise_columns(block, method):
+    # Columns of log2(TPM + 1) centred and scaled to unit length, so that the dot product of two
+    # columns is their Pearson correlation (of their ranks, for spearman). A constant column is
+    # all nan, as its correlations are undefined
+    block = np.log2(block + 1)
+    if method == 'spearman':
+        block = rank_columns(block)
+    block -= block.mean(axis=0)
+    norms = np.sqrt((block * block).sum(axis=0))
+    return np.divide(block, norms, out=np.full_like(block, np.nan), where=norms > 0)
+
+def write_correlation(tpmBase, outFile, method, isSparse, maxMemory, threads=1, nNeighbours=5):
+    # Library x library correlation of log2(TPM + 1) from the TPM matrix <tpmBase>, as
+    # <outFile>_correlation_<method>.npy (float32, rows and columns in .libraries.txt order), and
+    # each library's nearest neighbours in <outFile>_neighbours_<method>.tsv.
+    # The standardised columns are spilled to a temporary column-ordered file, then the matrix
+    # is filled a tile at a time (one BLAS matrix product of two column blocks per tile), tiles
+    # running on a pool of threads. --maxMemory (or CORRELATION_MEMORY) bounds the blocks held by
+    # all threads together
+    nGenes, nLibs, column_block = matrix_column_block(tpmBase, isSparse)
+    libIDs = read_labels(tpmBase)[1]
+    # A thread holds two float32 blocks, and standardising one takes about four float64 copies
+    width = max(1, int((maxMemory or CORRELATION_MEMORY) * 2**20 // (max(threads, 1) * 32 * nGenes)))
+    corrBase = outFile + '_correlation_' + method
+    shardDir = tempfile.mkdtemp(prefix='.' + os.path.basename(corrBase) + '.', dir=os.path.dirname(os.path.abspath(corrBase)))
+    try:
+        with open(os.path.join(shardDir, 'standardised'), 'wb') as shardFile:
+            for start in range(0, nLibs, width):
+                shardFile.write(standardise_columns(column_block(start, min(start + width, nLibs)), method).astype(np.float32).T.tobytes())
+        standardised = np.memmap(os.path.join(shardDir, 'standardised'), dtype=np.float32, mode='r', shape=(nGenes, nLibs), order='F')
+        corr = np.lib.format.open_memmap(corrBase + '.npy.tmp', mode='w+', dtype=np.float32, shape=(nLibs, nLibs))
+
+        def fill_tile(rowStart, colStart):
+            rowBlock = np.array(standardised[:, rowStart:rowStart + width])
+            colBlock = rowBlock if colStart == rowStart else np.array(standardised[:, colStart:colStart + width])
+            tile = np.clip(rowBlock.T @ colBlock, -1, 1)
+            corr[rowStart:rowStart + width, colStart:colStart + width] = tile
+            corr[colStart:colStart + width, rowStart:rowStart + width] = tile.T
+
+        with ThreadPoolExecutor(max(threads, 1)) as pool:
+            tiles = [pool.submit(fill_tile, rowStart, colStart) for rowStart in range(0, nLibs, width) for colStart in range(rowStart, nLibs, width)]
+            for tile in tiles:
+                tile.result()
+        corr.flush()
+        del corr, standardised
+    finally:
+        shutil.rmtree(shardDir)
+    os.replace(corrBase + '.npy.tmp', corrBase + '.npy')
+    with open(corrBase + '.libraries.txt', 'w') as libsFile:
+        libsFile.write('\n'.join(libIDs) + '\n')
+    write_neighbours(corrBase + '.npy', outFile + '_neighbours_' + method + '.tsv', libIDs, nNeighbours, width)
+    return corrBase + '.npy'
+
+def write_neighbours(corrPath, neighboursPath, libIDs, nNeighbours, width):
+    # For every library: its median correlation with all others (low for a failed library) and
+    # the nNeighbours libraries it correlates best with (a swapped library's best match is not
+    # its expected partner), read from the correlation matrix a block of rows at a time
+    corr = np.load(corrPath, mmap_mode='r')
+    nLibs = len(libIDs)
+    k = min(nNeighbours, nLibs - 1)
+    with open(neighboursPath, 'w') as neighboursFile:
+        header = ['Library', 'MedianCorrelation']
+        for n in range(1, k + 1):
+            header += ['Neighbour' + str(n), 'Correlation' + str(n)]
+        neighboursFile.write('\t'.join(header) + '\n')
+        for start in range(0, nLibs, width):
+            rows = np.array(corr[start:start + width], dtype=np.float64)
+            rows[np.arange(len(rows)), np.arange(start, start + len(rows))] = np.nan
+            ranked = np.where(np.isnan(rows), -np.inf, rows)
+            best = np.argpartition(-ranked, k - 1, axis=1)[:, :k] if k > 0 else np.zeros((len(rows), 0), dtype=np.int64)
+            best = np.take_along_axis(best, np.argsort(-np.take_along_axis(ranked, best, axis=1), axis=1, kind='stable'), axis=1)
+            medians = np.nanmedian(rows, axis=1) if nLibs > 1 else np.full(len(rows), np.nan)
+            for i, row in enumerate(rows):
+                fields = [libIDs[start + i], '%.4f' % medians[i]]
+                for j in best[i]:
+                    fields += [libIDs[j], '%.4f' % row[j]]
+                neighboursFile.write('\t'.join(fields) + '\n')
+
+def next_group_row(group, previousKey):
+    # The next row of a group of (file, path) that share one gene-ID column, read in lockstep:
+    # [gene ID, values of the first file, values of the second file, ...]; None at the end
+    row = next_row(group[0][0], group[0][1], previousKey)
+    if row is None:
+        return None
+    return [row[0], row[1:]] + [next_row(inFile, inPath, None)[1:] for inFile, inPath in group[1:]]
+
+def merge_join(inPaths, outPath, header, groups=None, tableFirst=False, compression='none', threads=1):
+    # Inner-join every input on its first column in one streaming k-way merge, the same
+    # result as join a b | join - c | ... | join - N but in one process, tab separated
+    # and with a header row. Inputs must be sorted on the gene ID (as LC_ALL=C sort does).
+    # groups are lists of indexes of inputs with the same gene-ID column (split_by_fingerprint),
+    # each read in lockstep as one input; a single group is a plain column concatenation,
+    # with no key comparisons and no need for sorted files. With tableFirst the first input is
+    # an existing joined table (--append) whose header row is skipped; outPath may be that table.
+    # Inputs may be compressed; the output is compressed as it is written with compression.
+    # The table is written to a temporary file and only renamed to outPath once complete
+    if groups is None:
+        groups = [[i] for i in range(len(inPaths))]
+    raise_open_file_limit(len(inPaths))
+    inFiles = [compressed_io.open_input(inPath) for inPath in inPaths]
+    if tableFirst:
+        inFiles[0].readline()
+    groupFiles = [[(inFiles[i], inPaths[i]) for i in group] for group in groups]
+    # Position of each input's values in a merged row, to write them back in input order
+    readOrder = [i for group in groups for i in group]
+    position = [readOrder.index(i) for i in range(len(inPaths))]
+    checkOrder = len(groups) > 1
+    nRows = 0
+    try:
+        with compressed_io.open_output(outPath + '.tmp', 'w', compression, threads) as outFile:
+            outFile.write('\t'.join(header) + '\n')
+            rows = [next_group_row(group, None) for group in groupFiles]
+            while None not in rows:
+                maxKey = max(row[0] for row in rows)
+                if all(row[0] == maxKey for row in rows):
+                    values = [fields for row in rows for fields in row[1:]]
+                    outFile.write(maxKey)
+                    for i in position:
+                        outFile.write('\t' + '\t'.join(values[i]))
+                    outFile.write('\n')
+                    nRows += 1
+                    rows = [next_group_row(group, row[0] if checkOrder else None) for group, row in zip(groupFiles, rows)]
+                else:
+                    for i, row in enumerate(rows):
+                        while row is not None and row[0] < maxKey:
+                            row = next_group_row(groupFiles[i], row[0])
+                        rows[i] = row
+    except BaseException:
+        os.remove(outPath + '.tmp')
+        raise
+    finally:
+        for inFile in inFiles:
+            inFile.close()
+    os.replace(outPath + '.tmp', outPath)
+    return nRows
 
 
 ### ........ DEFINE COMMAND LINE ARGUMENTS & VARIABLES ........###
@@ -66,7 +1022,95 @@ parser.add_argument('dataType', metavar='dataType', type=str, choices = ("tpm",
 parser.add_argument('outFile', type=str,
                     help='base name of output file (s)')
 
+parser.add_argument('--manifest', type=str, default='',
+                    help='read the library files from this manifest (<outFile>_manifest.tsv of an earlier run) instead of scanning libDirectory, to join exactly the same files again')
+
+parser.add_argument('--mode', type=str, choices = ("script", "native", "matrix", "sparse"), default='script',
+                    help='script = write a join script to run yourself, native = join the files directly in one streaming merge, with a header row (and an index for query_exprs_table.py), matrix = build a genes x libraries NumPy array (<outFile>_<TYPE>.npy, with .genes.txt and .libraries.txt), sparse = the same matrix, keeping only non-zero values (meant for counts, see --sparseFormat)')
+
+parser.add_argument('--append', action='store_true',
+                    help='add the libraries that are not in an existing output (from an earlier run with the same outFile and --mode native, matrix or sparse) as new columns, instead of joining everything again')
+
+parser.add_argument('--compress', type=str, choices = compressed_io.COMPRESSIONS, default='none',
+                    help='compress the joined tables (--mode native, and --mode sparse with --sparseFormat mtx) as they are written: gzip (.gz, across --jobs threads) or zstd (.zst, needs the zstandard module). Compressed library files are always read as they are')
+
+parser.add_argument('--jobs', type=int, default=1,
+                    help='threads to compress with (--compress) and to compute --correlation tiles on')
+
+parser.add_argument('--maxMemory', '--max-memory', type=float, default=0,
+                    help='with --mode matrix or sparse, build the matrix in blocks of libraries using at most about this many MB, spilling each block to disk (0 = all in memory). --mode native streams rows and needs little memory whatever the number of libraries')
+
+parser.add_argument('--abundance', action='store_true',
+                    help='with dataType all in --mode matrix or sparse, read TPM and FPKM together from each library\'s stringtie gene abundance file (' + ABUNDANCE_FILE + ') instead of its TPM and FPKM files; only if the first library\'s abundance file has the same gene IDs as those files')
+
+parser.add_argument('--geneMap', type=str, default='',
+                    help='transcript-to-gene map (transcript ID and gene ID columns) for --mode matrix or sparse: the libraries\' transcript TPM and FPKM are summed into genes, giving gene-level TPM and FPKM matrices (in the order genes first appear in the map); counts, already gene level, are read as they are')
+
+parser.add_argument('--libraryStats', action='store_true',
+                    help='with --mode matrix or sparse, also write <outFile>_libraryStats.tsv: for every library and kind of data, its total, genes detected (above --detectedAbove), fraction of the total in its top ' + str(TOP_GENES) + ' genes and in the --mitoGenes and --rRNAGenes, gathered as the matrices are built')
+
+parser.add_argument('--detectedAbove', type=float, default=0,
+                    help='--libraryStats counts a gene as detected when its value is above this (default: 0)')
+
+parser.add_argument('--mitoGenes', type=str, default='',
+                    help='--libraryStats: file of mitochondrial gene IDs, one per line')
+
+parser.add_argument('--rRNAGenes', type=str, default='',
+                    help='--libraryStats: file of rRNA gene IDs, one per line')
+
+parser.add_argument('--correlation', type=str, default='',
+                    help='comma-separated correlations (pearson, spearman) of every pair of libraries on log2(TPM + 1), from the TPM matrix (--mode matrix, or sparse with npz): <outFile>_correlation_<method>.npy and each library\'s nearest neighbours in <outFile>_neighbours_<method>.tsv. Computed in tiles on --jobs threads, within --maxMemory (default ' + str(CORRELATION_MEMORY) + ' MB)')
+
+parser.add_argument('--neighbours', type=int, default=5,
+                    help='number of nearest neighbours listed per library with --correlation (default: 5)')
+
+parser.add_argument('--normalise', type=str, default='',
+                    help='comma-separated normalisations of the counts to write next to the RAWCOUNTS matrix (--mode matrix, or sparse with npz): cpm, logcpm (log2(CPM + 1)), tpm (needs --geneLengths) and sizefactors (<outFile>_sizeFactors.tsv: total counts and median-of-ratios size factor of each library)')
+
+parser.add_argument('--geneLengths', type=str, default='',
+                    help='gene lengths for --normalise tpm: gene ID and length in bases, or a featureCounts table (its Length column)')
+
+parser.add_argument('--sparseFormat', type=str, choices = ("npz", "mtx"), default='npz',
+                    help='file written by --mode sparse: npz = compressed sparse columns, loads with scipy.sparse.load_npz (<outFile>_<TYPE>.npz), mtx = Matrix Market (<outFile>_<TYPE>.mtx)')
+
 args = parser.parse_args()
+if args.append and args.mode == "script":
+    print("\nERROR: --append needs --mode native, matrix or sparse")
+    exit()
+if compressed_io.check_compression(args.compress):
+    print("\nERROR: " + compressed_io.check_compression(args.compress))
+    exit()
+if args.mode in ("matrix", "sparse") and np is None:
+    print("\nERROR: --mode " + args.mode + " needs numpy, which is not installed")
+    exit()
+if args.geneMap and args.mode not in ("matrix", "sparse"):
+    print("\nERROR: --geneMap needs --mode matrix or sparse")
+    exit()
+if args.abundance and (args.mode not in ("matrix", "sparse") or args.geneMap):
+    print("\nERROR: --abundance needs --mode matrix or sparse, and cannot be used with --geneMap (abundance files are gene level)")
+    exit()
+if args.libraryStats and args.mode not in ("matrix", "sparse"):
+    print("\nERROR: --libraryStats needs --mode matrix or sparse")
+    exit()
+correlations = [method for method in args.correlation.lower().split(',') if method]
+if correlations:
+    if [method for method in correlations if method not in CORRELATIONS]:
+        print("\nERROR: --correlation takes " + ", ".join(CORRELATIONS) + ", not " + ", ".join(method for method in correlations if method not in CORRELATIONS))
+        exit()
+    if args.mode not in ("matrix", "sparse") or (args.mode == "sparse" and args.sparseFormat != "npz") or "TPM" not in DATA_TYPES[args.dataType]:
+        print("\nERROR: --correlation needs the TPM (dataType tpm or all) in --mode matrix, or --mode sparse with --sparseFormat npz")
+        exit()
+normalisations = [kind for kind in args.normalise.lower().split(',') if kind]
+if normalisations:
+    if [kind for kind in normalisations if kind not in NORMALISATIONS]:
+        print("\nERROR: --normalise takes " + ", ".join(NORMALISATIONS) + ", not " + ", ".join(kind for kind in normalisations if kind not in NORMALISATIONS))
+        exit()
+    if args.mode not in ("matrix", "sparse") or (args.mode == "sparse" and args.sparseFormat != "npz") or "RAWCOUNTS" not in DATA_TYPES[args.dataType]:
+        print("\nERROR: --normalise needs the counts (dataType counts or all) in --mode matrix, or --mode sparse with --sparseFormat npz")
+        exit()
+    if "tpm" in normalisations and not args.geneLengths:
+        print("\nERROR: --normalise tpm needs --geneLengths")
+        exit()
 #print(args.libDirectory)
 #print(args.libList)
 #print(args.dataType)
@@ -132,60 +1176,179 @@ for i in matchedListInOrder:
 
 # STEP 4) Write the join script
 #   (argument = dataType)
-#   Write to a bash file or execute directly
+#   Write to a bash file or execute directly (--mode native)
 #with open("joinScript_tpm.sh", "w") as joinFile_tpm, open("joinScript_fpkm.sh", "w") as joinFile_fpkm, open("joinScript_counts.sh", "w") as joinFile_counts:
 
-if args.dataType == "tpm":
+# Libraries in the order of the output's columns (with --append, those already in it first)
+tableLibs = matchedListInOrder
+#   Every library's files are found once, for all the kinds of data to join, and recorded in
+#   <outFile>_manifest.tsv; the joins (and the join scripts) use those paths, not globs
+if args.manifest:
+   libFiles = read_manifest(args.manifest, matchedListInOrder, DATA_TYPES[args.dataType])
+   print("\nLIBRARY FILES READ FROM " + args.manifest)
+else:
+   libFiles = resolve_library_files(args.libDirectory, matchedListInOrder, DATA_TYPES[args.dataType])
+   write_manifest(args.outFile + "_manifest.tsv", libFiles, matchedListInOrder, DATA_TYPES[args.dataType])
+   print("\nLIBRARY FILES WRITTEN TO " + args.outFile + "_manifest.tsv")
+if args.mode == "native":
+   for dataName in DATA_TYPES[args.dataType]:
+      outPath = compressed_io.output_name(args.outFile + "_" + dataName + ".tsv", args.compress)
+      if args.append and os.path.exists(outPath):
+         with compressed_io.open_input(outPath) as tableFile:
+            header = tableFile.readline().split()
+         newLibs = [i for i in matchedListInOrder if i not in header[1:]]
+         tableLibs = header[1:] + newLibs
+         if not newLibs:
+            print("\n" + outPath + " ALREADY HAS EVERY LIBRARY, NOTHING TO APPEND")
+            continue
+         inPaths = [outPath] + [libFiles[i][dataName] for i in newLibs]
+         print("\nAPPENDING " + str(len(newLibs)) + " " + dataName + " FILES TO " + outPath + " (" + str(len(header) - 1) + " libraries)")
+         same, different = split_by_fingerprint(inPaths, [outPath] + newLibs, tableFirst=True)
+         nRows = merge_join(inPaths, outPath, header + newLibs, [same] + [[i] for i in different], True, args.compress, args.jobs)
+         print("\tWrote " + str(nRows) + " genes x " + str(len(tableLibs)) + " libraries")
+         if args.compress == "none":
+            exprs_index.write_index(outPath)
+         continue
+      inPaths = [libFiles[i][dataName] for i in matchedListInOrder]
+      print("\nJOINING " + str(len(inPaths)) + " " + dataName + " FILES INTO " + outPath)
+      same, different = split_by_fingerprint(inPaths, matchedListInOrder)
+      if not different:
+         print("\tAll files have the same genes in the same order, pasting their columns together")
+      nRows = merge_join(inPaths, outPath, ["GeneID"] + matchedListInOrder, [same] + [[i] for i in different], False, args.compress, args.jobs)
+      print("\tWrote " + str(nRows) + " genes x " + str(len(inPaths)) + " libraries")
+      # Index of each gene's row, for query_exprs_table.py (a compressed table cannot be read at an offset)
+      if args.compress == "none":
+         exprs_index.write_index(outPath)
+         print("\tIndexed it in " + outPath + exprs_index.INDEX_SUFFIX)
+elif args.mode in ("matrix", "sparse"):
+   # With --abundance, TPM and FPKM are read from stringtie's gene abundance files in a single pass
+   # that builds both (only here: --mode native needs files sorted on gene ID)
+   extension = ".npy" if args.mode == "matrix" else "." + args.sparseFormat
+   if args.sparseFormat == "mtx":
+      extension = compressed_io.output_name(extension, args.compress)
+   geneMap = None
+   libraryStats = None
+   if args.geneMap:
+      geneMap = read_gene_map(args.geneMap)
+      print("\nSUMMING TRANSCRIPTS INTO GENES: " + str(len(geneMap)) + " transcripts of " + str(len(set(geneMap.values()))) + " genes in " + args.geneMap)
+   if args.libraryStats:
+      geneSets = [(name, read_gene_list(listPath)) for name, listPath in (("Mito", args.mitoGenes), ("rRNA", args.rRNAGenes)) if listPath]
+      libraryStats = new_library_stats(args.detectedAbove, geneSets)
+   useAbundance = args.abundance and abundance_usable(libFiles, matchedListInOrder, DATA_TYPES[args.dataType])
+   for dataNames, sources in read_passes(libFiles, matchedListInOrder, DATA_TYPES[args.dataType], useAbundance):
+      if isinstance(sources[matchedListInOrder[0]], str):
+         print("\nREADING " + dataNames[0] + " FROM " + DATA_FILES[dataNames[0]] + " FILES")
+      else:
+         print("\nREADING " + " AND ".join(dataNames) + " TOGETHER FROM " + ABUNDANCE_FILE + " FILES (--abundance)")
+      # Counts files are already gene level: --geneMap only sums the transcript TPM and FPKM
+      passMap = None if 'RAWCOUNTS' in dataNames else geneMap
+      # Kinds of data appended to outputs with the same genes and missing the same libraries
+      # are read together, as are all those built in blocks, and all those built at once
+      appendGroups = {}
+      blockedNames = []
+      buildNames = []
+      for dataName in dataNames:
+         outBase = args.outFile + "_" + dataName
+         if args.append and os.path.exists(outBase + extension):
+            geneIDs, libIDs = read_labels(outBase)
+            newLibs = [i for i in matchedListInOrder if i not in libIDs]
+            if not newLibs:
+               print("\n" + outBase + extension + " ALREADY HAS EVERY LIBRARY, NOTHING TO APPEND")
+               continue
+            appendGroups.setdefault((tuple(newLibs), tuple(geneIDs)), []).append(dataName)
+         elif args.maxMemory:
+            blockedNames.append(dataName)
+         else:
+            buildNames.append(dataName)
+      for (newLibs, geneIDs), appendNames in appendGroups.items():
+         newLibs = list(newLibs)
+         outBases = [args.outFile + "_" + dataName for dataName in appendNames]
+         newSources = [select_source(sources[i], appendNames) for i in newLibs]
+         print("\nAPPENDING " + str(len(newLibs)) + " " + " + ".join(appendNames) + " FILES TO " + ", ".join(outBase + extension for outBase in outBases))
+         if args.mode == "matrix":
+            for dataName, (shape, inPlace) in zip(appendNames, append_matrix(outBases, newSources, newLibs, appendNames, passMap, libraryStats)):
+               print("\tWrote " + dataName + ": " + str(shape[0]) + " genes x " + str(shape[1]) + " libraries (" + ("in place" if inPlace else "rewritten") + ")")
+         else:
+            for dataName, (shape, nValues) in zip(appendNames, append_sparse(outBases, newSources, newLibs, appendNames, args.sparseFormat, args.compress, args.jobs, passMap, libraryStats)):
+               print("\tWrote " + dataName + ": " + str(shape[0]) + " genes x " + str(shape[1]) + " libraries, " + str(nValues) + " non-zero values")
+      if blockedNames:
+         outBases = [args.outFile + "_" + dataName for dataName in blockedNames]
+         libSources = [select_source(sources[i], blockedNames) for i in matchedListInOrder]
+         print("\nLOADING " + str(len(libSources)) + " " + " + ".join(blockedNames) + " FILES INTO " + ", ".join(outBase + extension for outBase in outBases))
+         if args.mode == "matrix":
+            shape = write_blocked_matrix(libSources, matchedListInOrder, blockedNames, outBases, args.maxMemory, passMap, libraryStats)
+            for dataName in blockedNames:
+               print("\tWrote " + dataName + ": " + str(shape[0]) + " genes x " + str(shape[1]) + " libraries (" + MATRIX_DTYPES[dataName] + ")")
+         else:
+            shape, nValues = write_blocked_sparse(libSources, matchedListInOrder, blockedNames, outBases, args.sparseFormat, args.maxMemory, args.compress, args.jobs, passMap, libraryStats)
+            for dataName, n in zip(blockedNames, nValues):
+               print("\tWrote " + dataName + ": " + str(shape[0]) + " genes x " + str(shape[1]) + " libraries, " + str(n) + " non-zero values")
+      if not buildNames:
+         continue
+      libSources = [select_source(sources[i], buildNames) for i in matchedListInOrder]
+      print("\nLOADING " + str(len(libSources)) + " " + " + ".join(buildNames) + " FILES INTO " + ", ".join(args.outFile + "_" + dataName + extension for dataName in buildNames))
+      if args.mode == "matrix":
+         matrices, geneIDs = build_matrix(libSources, matchedListInOrder, buildNames, geneMap=passMap, stats=libraryStats)
+         for dataName, matrix in zip(buildNames, matrices):
+            save_matrix(args.outFile + "_" + dataName, matrix, geneIDs, matchedListInOrder)
+            print("\tWrote " + dataName + ": " + str(matrix.shape[0]) + " genes x " + str(matrix.shape[1]) + " libraries (" + str(matrix.dtype) + ")")
+      else:
+         sparseMatrices, geneIDs = build_sparse(libSources, matchedListInOrder, buildNames, geneMap=passMap, stats=libraryStats)
+         for dataName, sparse in zip(buildNames, sparseMatrices):
+            save_sparse(args.outFile + "_" + dataName, sparse, geneIDs, matchedListInOrder, args.sparseFormat, args.compress, args.jobs)
+            nCells = sparse['shape'][0] * sparse['shape'][1]
+            print("\tWrote " + dataName + ": " + str(sparse['shape'][0]) + " genes x " + str(sparse['shape'][1]) + " libraries, " + str(len(sparse['data'])) + " non-zero values (" + str(round(100.0 * len(sparse['data']) / max(nCells, 1), 1)) + "%)")
+elif args.dataType == "tpm":
    with open("joinScript_tpm.sh", "w") as joinFile_tpm:
-      joinFile_tpm.write("join " + args.libDirectory + (matchedListInOrder)[0] + "*/stringtie_out/*TPM.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/stringtie_out/*TPM.tsv")
-      print("\nYOUR JOIN COMMAND IS:\njoin " + args.libDirectory + (matchedListInOrder)[0] + "*/stringtie_out/*TPM.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/stringtie_out/*TPM.tsv", end =" ")
+      joinFile_tpm.write("join " + script_path(libFiles[matchedListInOrder[0]]['TPM']) + " " + script_path(libFiles[matchedListInOrder[1]]['TPM']))
+      print("\nYOUR JOIN COMMAND IS:\njoin " + script_path(libFiles[matchedListInOrder[0]]['TPM']) + " " + script_path(libFiles[matchedListInOrder[1]]['TPM']), end =" ")
       for i in (matchedListInOrder)[2:]:
-         joinFile_tpm.write(" | join - " + args.libDirectory + i + "*/stringtie_out/*TPM.tsv")
-         print (" | join - " + args.libDirectory + i + "*/stringtie_out/*TPM.tsv", end =" ")
+         joinFile_tpm.write(" | join - " + script_path(libFiles[i]['TPM']))
+         print (" | join - " + script_path(libFiles[i]['TPM']), end =" ")
       joinFile_tpm.write(" > " + args.outFile + "_TPM.tsv")
       print(" > " + args.outFile + "_TPM.tsv")
       print("When you are satisfied, run the following command:\n bash joinScript_tpm.sh")
 elif args.dataType == "fpkm":
    with open("joinScript_fpkm.sh", "w") as joinFile_fpkm:
-      joinFile_fpkm.write("join " + args.libDirectory + (matchedListInOrder)[0] + "*/stringtie_out/*FPKM.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/stringtie_out/*FPKM.tsv")
-      print("\nYOUR JOIN COMMAND IS:\njoin " + args.libDirectory + (matchedListInOrder)[0] + "*/stringtie_out/*FPKM.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/stringtie_out/*FPKM.tsv", end =" ")
+      joinFile_fpkm.write("join " + script_path(libFiles[matchedListInOrder[0]]['FPKM']) + " " + script_path(libFiles[matchedListInOrder[1]]['FPKM']))
+      print("\nYOUR JOIN COMMAND IS:\njoin " + script_path(libFiles[matchedListInOrder[0]]['FPKM']) + " " + script_path(libFiles[matchedListInOrder[1]]['FPKM']), end =" ")
       for i in (matchedListInOrder)[2:]:
-         joinFile_fpkm.write(" | join - " + args.libDirectory +  i + "*/stringtie_out/*FPKM.tsv")
-         print(" | join - " + args.libDirectory + i + "*/stringtie_out/*FPKM.tsv", end =" ")
+         joinFile_fpkm.write(" | join - " + script_path(libFiles[i]['FPKM']))
+         print(" | join - " + script_path(libFiles[i]['FPKM']), end =" ")
       joinFile_fpkm.write(" > " + args.outFile + "_FPKM.tsv")
       print(" > " + args.outFile + "_FPKM.tsv")
       print("When you are satisfied, run the following command:\n bash joinScript_fpkm.sh")
 elif args.dataType == "counts":
    with open("joinScript_counts.sh", "w") as joinFile_counts:
-      joinFile_counts.write("join " + args.libDirectory + (matchedListInOrder)[0] + "*/rawcounts_output/*RAWCOUNTS.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/rawcounts_output/*RAWCOUNTS.tsv")
-      print("\nYOUR JOIN COMMAND IS:\njoin " + args.libDirectory + (matchedListInOrder)[0] + "*/rawcounts_output/*RAWCOUNTS.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/rawcounts_output/*RAWCOUNTS.tsv", end =" ")
+      joinFile_counts.write("join " + script_path(libFiles[matchedListInOrder[0]]['RAWCOUNTS']) + " " + script_path(libFiles[matchedListInOrder[1]]['RAWCOUNTS']))
+      print("\nYOUR JOIN COMMAND IS:\njoin " + script_path(libFiles[matchedListInOrder[0]]['RAWCOUNTS']) + " " + script_path(libFiles[matchedListInOrder[1]]['RAWCOUNTS']), end =" ")
       for i in (matchedListInOrder)[2:]:
-         joinFile_counts.write(" | join - " + args.libDirectory + i + "*/rawcounts_output/*RAWCOUNTS.tsv")
-         print(" | join - " + args.libDirectory + i + "*/rawcounts_output/*RAWCOUNTS.tsv", end =" ")
+         joinFile_counts.write(" | join - " + script_path(libFiles[i]['RAWCOUNTS']))
+         print(" | join - " + script_path(libFiles[i]['RAWCOUNTS']), end =" ")
       joinFile_counts.write(" > " + args.outFile + "_RAWCOUNTS.tsv")
       print(" > " + args.outFile + "_RAWCOUNTS.tsv")
       print("When you are satisfied, run the following command:\n bash joinScript_counts.sh")
 elif args.dataType == "all":
    with open("joinScript_all.sh", "w") as joinFile_all:
-      joinFile_all.write("join " + args.libDirectory + (matchedListInOrder)[0] + "*/stringtie_out/*TPM.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/stringtie_out/*TPM.tsv")
-      print("\nYOUR TPM JOIN COMMAND IS:\njoin " + args.libDirectory + (matchedListInOrder)[0] + "*/stringtie_out/*TPM.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/stringtie_out/*TPM.tsv", end =" ")
+      joinFile_all.write("join " + script_path(libFiles[matchedListInOrder[0]]['TPM']) + " " + script_path(libFiles[matchedListInOrder[1]]['TPM']))
+      print("\nYOUR TPM JOIN COMMAND IS:\njoin " + script_path(libFiles[matchedListInOrder[0]]['TPM']) + " " + script_path(libFiles[matchedListInOrder[1]]['TPM']), end =" ")
       for i in (matchedListInOrder)[2:]:
-         joinFile_all.write(" | join - " + args.libDirectory + i + "*/stringtie_out/*TPM.tsv")
-         print(" | join - " + args.libDirectory + i + "*/stringtie_out/*TPM.tsv", end =" ")
+         joinFile_all.write(" | join - " + script_path(libFiles[i]['TPM']))
+         print(" | join - " + script_path(libFiles[i]['TPM']), end =" ")
       joinFile_all.write(" > " + args.outFile + "_TPM.tsv")
       print(" > " + args.outFile + "_TPM.tsv")
-      joinFile_all.write("\njoin " + args.libDirectory + (matchedListInOrder)[0] + "*/stringtie_out/*FPKM.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/stringtie_out/*FPKM.tsv")
-      print("\nYOUR FPKM JOIN COMMAND IS:\njoin " + args.libDirectory + (matchedListInOrder)[0] + "*/stringtie_out/*FPKM.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/stringtie_out/*FPKM.tsv", end =" ")
+      joinFile_all.write("\njoin " + script_path(libFiles[matchedListInOrder[0]]['FPKM']) + " " + script_path(libFiles[matchedListInOrder[1]]['FPKM']))
+      print("\nYOUR FPKM JOIN COMMAND IS:\njoin " + script_path(libFiles[matchedListInOrder[0]]['FPKM']) + " " + script_path(libFiles[matchedListInOrder[1]]['FPKM']), end =" ")
       for i in (matchedListInOrder)[2:]:
-         joinFile_all.write(" | join - " + args.libDirectory + i + "*/stringtie_out/*FPKM.tsv")
-         print(" | join - " + args.libDirectory + i + "*/stringtie_out/*FPKM.tsv", end =" ")
+         joinFile_all.write(" | join - " + script_path(libFiles[i]['FPKM']))
+         print(" | join - " + script_path(libFiles[i]['FPKM']), end =" ")
       joinFile_all.write(" > " + args.outFile + "_FPKM.tsv")
       print(" > " + args.outFile + "_FPKM.tsv")
-      joinFile_all.write("\njoin " + args.libDirectory + (matchedListInOrder)[0] + "*/rawcounts_output/*RAWCOUNTS.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/rawcounts_output/*RAWCOUNTS.tsv")
-      print("\nYOUR COUNTS JOIN COMMAND IS:\njoin " + args.libDirectory + (matchedListInOrder)[0] + "*/rawcounts_output/*RAWCOUNTS.tsv " + args.libDirectory + (matchedListInOrder[1]) + "*/rawcounts_output/*RAWCOUNTS.tsv", end =" ")
+      joinFile_all.write("\njoin " + script_path(libFiles[matchedListInOrder[0]]['RAWCOUNTS']) + " " + script_path(libFiles[matchedListInOrder[1]]['RAWCOUNTS']))
+      print("\nYOUR COUNTS JOIN COMMAND IS:\njoin " + script_path(libFiles[matchedListInOrder[0]]['RAWCOUNTS']) + " " + script_path(libFiles[matchedListInOrder[1]]['RAWCOUNTS']), end =" ")
       for i in (matchedListInOrder)[2:]:
-         joinFile_all.write(" | join - " + args.libDirectory + i + "*/rawcounts_output/*RAWCOUNTS.tsv")
-         print(" | join - " + args.libDirectory + i + "*/rawcounts_output/*RAWCOUNTS.tsv", end =" ")
+         joinFile_all.write(" | join - " + script_path(libFiles[i]['RAWCOUNTS']))
+         print(" | join - " + script_path(libFiles[i]['RAWCOUNTS']), end =" ")
       joinFile_all.write(" > " + args.outFile + "_RAWCOUNTS.tsv")
       print(" > " + args.outFile + "_RAWCOUNTS.tsv")
       print("When you are satisfied, run the following command:\n bash joinScript_all.sh")
@@ -194,12 +1357,38 @@ elif args.dataType == "all":
 #    joinFile.write("> " + args.outFile)
 #print("> " + args.outFile)
 
+# STEP 4b) Write the library statistics gathered while building the matrices (--libraryStats)
+if args.libraryStats:
+   write_library_stats(args.outFile + "_libraryStats.tsv", libraryStats, matchedListInOrder, args.append)
+   print("\nWROTE STATISTICS OF " + str(len(libraryStats['rows'])) + " LIBRARIES TO " + args.outFile + "_libraryStats.tsv")
+
+# STEP 4c) Normalise the counts matrix, if asked (--normalise), from the matrix just written
+if normalisations:
+   geneLengths = read_gene_lengths(args.geneLengths) if args.geneLengths else {}
+   print("\nNORMALISING " + args.outFile + "_RAWCOUNTS: " + ", ".join(normalisations))
+   if args.mode == "matrix":
+      written = write_normalised_matrix(args.outFile + "_RAWCOUNTS", args.outFile, normalisations, geneLengths, args.maxMemory)
+   else:
+      written = write_normalised_sparse(args.outFile + "_RAWCOUNTS", args.outFile, normalisations, geneLengths, args.maxMemory)
+   if "sizefactors" in normalisations:
+      written.append(args.outFile + "_sizeFactors.tsv")
+   print("\tWrote " + ", ".join(written))
+
+# STEP 4d) Correlate every pair of libraries on log2(TPM + 1), if asked (--correlation)
+for method in correlations:
+   print("\nCORRELATING " + args.outFile + "_TPM LIBRARIES (" + method + ")")
+   corrPath = write_correlation(args.outFile + "_TPM", args.outFile, method, args.mode == "sparse", args.maxMemory, args.jobs, args.neighbours)
+   print("\tWrote " + corrPath + " and " + args.outFile + "_neighbours_" + method + ".tsv")
+
 # STEP 5) Write the header files
+#   (not needed for --mode matrix or sparse, which write their own .genes.txt and .libraries.txt)
+if args.mode in ("matrix", "sparse"):
+   exit()
 with open("R_header.txt", 'w') as headerFile:
-   for i in matchedListInOrder:
+   for i in tableLibs:
     headerFile.write("\"" + i + "\", ")
 with open("JMP_header.txt", 'w') as headerFile2:
-   for i in matchedListInOrder:
+   for i in tableLibs:
     headerFile2.write(i + "\t")
 
 
@@ -18,11 +18,13 @@
 #     2) align_summary.txt - line 14 (total mapping percent)
 #     3) fcounts summary - get percentage mapped (divide assigned reads by sum of total reads)
 #     4) print filename (with lib ID), mapping alignment, and featurecounts percentages in an excel readable table
+#     5) optionally upsert the same numbers into the SQLite QC warehouse (see qc_warehouse.py)
 
 
 import os
 import sys
 import re
+import qc_warehouse
 
 # DECLARE VARIABLES
 
@@ -30,6 +32,10 @@ direc_to_scan = "/var/www/subdirectories_for_interface/theDirectoryRNAOutput/spr
 
 allStats = os.path.join(direc_to_scan, "D6D16redo_alignment.txt")                       # the name of the file to output
 fcountStats = os.path.join(direc_to_scan, "D6D16redo_fcountStats.txt")
+qcDatabase = None                                                                        # SQLite QC warehouse to also upsert into, e.g. "/var/www/qc_warehouse.sqlite"
+project = os.path.basename(direc_to_scan)
+alignRows = []
+assignRows = []
       
 
 for root, dirs, files in os.walk(direc_to_scan):
@@ -47,6 +53,7 @@ for root, dirs, files in os.walk(direc_to_scan):
                         alignRate = basename1 + '\t' + reads + '\t' + alignPercent + '\n'
                         with open(allStats, 'a') as outFile:
                             outFile.write(alignRate)
+                        alignRows.append((basename1.split("_")[0], basename1, project, qc_warehouse.to_number(reads, int), qc_warehouse.to_number(alignPercent)))
 for root, dirs, files in os.walk(direc_to_scan):
     seqName = (dirs)
     for file in files:
@@ -62,3 +69,11 @@ for root, dirs, files in os.walk(direc_to_scan):
                         assignRate = (basename + '\t' + total + '\t' + percent + '\n')
                         with open(fcountStats, 'a') as outFile2:
                             outFile2.write(assignRate)
+                        assignRows.append((basename.split("_")[0], basename, project, qc_warehouse.to_number(total, int), qc_warehouse.to_number(percent)))
+
+if qcDatabase is not None:
+    conn = qc_warehouse.connect(qcDatabase)
+    with conn:
+        qc_warehouse.upsert_alignment(conn, alignRows)
+        qc_warehouse.upsert_assignment(conn, assignRows)
+    conn.close()
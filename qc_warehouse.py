@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+### ........ ABOUT ........###
+
+# SQLite QC warehouse shared by collect_qc_info.py (--db) and mapping_stats_080318.py (qcDatabase).
+# Every run upserts its rows, so one database collects QC results across projects and re-runs
+# replace a library's old rows instead of adding duplicates.
+#
+# Tables (upserted by library and read type, or by library output directory for mapping stats):
+#   libraries          library, read_type (e.g. R2_trimmed), project, report, url, qc_date, total_sequences
+#   module_status      library, read_type, module (fastQC_summary.tsv column names), status
+#   overrepresented    library, read_type, sequence, count, percentage, possible_source
+#   alignment          library, run (library output directory), project, reads, align_rate
+#   assignment         library, run, project, total, assign_rate
+#
+# Example: all R2 libraries with FAIL in PerBaseSeqContent in 2020
+#   SELECT l.* FROM libraries l JOIN module_status m USING (library, read_type)
+#   WHERE l.read_type LIKE 'R2%' AND m.module = 'PerBaseSeqContent' AND m.status = 'FAIL'
+#     AND l.qc_date BETWEEN '2020-01-01' AND '2020-12-31';
+
+### ........ IMPORT MODULES ........###
+
+import re
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS libraries (
+    library TEXT NOT NULL,
+    read_type TEXT NOT NULL,
+    project TEXT,
+    report TEXT,
+    url TEXT,
+    qc_date TEXT,
+    total_sequences INTEGER,
+    PRIMARY KEY (library, read_type)
+);
+CREATE INDEX IF NOT EXISTS libraries_by_project ON libraries (project);
+CREATE INDEX IF NOT EXISTS libraries_by_date ON libraries (qc_date);
+
+CREATE TABLE IF NOT EXISTS module_status (
+    library TEXT NOT NULL,
+    read_type TEXT NOT NULL,
+    module TEXT NOT NULL,
+    status TEXT,
+    PRIMARY KEY (library, read_type, module)
+);
+CREATE INDEX IF NOT EXISTS module_status_by_module ON module_status (module, status);
+
+CREATE TABLE IF NOT EXISTS overrepresented (
+    library TEXT NOT NULL,
+    read_type TEXT NOT NULL,
+    sequence TEXT NOT NULL,
+    count INTEGER,
+    percentage REAL,
+    possible_source TEXT,
+    PRIMARY KEY (library, read_type, sequence)
+);
+CREATE INDEX IF NOT EXISTS overrepresented_by_sequence ON overrepresented (sequence);
+
+CREATE TABLE IF NOT EXISTS alignment (
+    library TEXT NOT NULL,
+    run TEXT NOT NULL,
+    project TEXT,
+    reads INTEGER,
+    align_rate REAL,
+    PRIMARY KEY (library, run)
+);
+
+CREATE TABLE IF NOT EXISTS assignment (
+    library TEXT NOT NULL,
+    run TEXT NOT NULL,
+    project TEXT,
+    total INTEGER,
+    assign_rate REAL,
+    PRIMARY KEY (library, run)
+);
+"""
+
+### ........ DEFINE FUNCTIONS ........###
+
+def connect(dbPath):
+    # Open (creating if needed) the warehouse in WAL mode, so readers are not blocked while a run writes
+    conn = sqlite3.connect(dbPath)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+def to_number(text, type=float):
+    # Numbers as the QC tools print them, e.g. '1,234', '98.19%' or '(56.7%)'; None if there is none
+    match = re.search(r'-?[\d.]+(?:[eE][-+]?\d+)?', str(text).replace(',', ''))
+    if match is None:
+        return None
+    try:
+        return type(float(match.group(0)))
+    except ValueError:
+        return None
+
+def split_sample(sample):
+    # '1234_R2_trimmed' -> ('1234', 'R2_trimmed'); a bare library ID has an empty read type
+    library, _, readType = sample.strip().partition('_')
+    return library, readType
+
+def upsert_libraries(conn, rows):
+    # rows: (library, read_type, project, report, url, qc_date, total_sequences)
+    conn.executemany("""INSERT INTO libraries VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (library, read_type) DO UPDATE SET project = excluded.project, report = excluded.report,
+        url = excluded.url, qc_date = excluded.qc_date, total_sequences = excluded.total_sequences""", rows)
+
+def upsert_module_status(conn, rows):
+    # rows: (library, read_type, module, status)
+    conn.executemany("""INSERT INTO module_status VALUES (?, ?, ?, ?)
+        ON CONFLICT (library, read_type, module) DO UPDATE SET status = excluded.status""", rows)
+
+def replace_overrepresented(conn, samples, rows):
+    # The overrepresented sequences of each (library, read_type) in samples are replaced by rows:
+    # (library, read_type, sequence, count, percentage, possible_source)
+    conn.executemany("DELETE FROM overrepresented WHERE library = ? AND read_type = ?", samples)
+    conn.executemany("""INSERT INTO overrepresented VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (library, read_type, sequence) DO UPDATE SET count = excluded.count,
+        percentage = excluded.percentage, possible_source = excluded.possible_source""", rows)
+
+def upsert_alignment(conn, rows):
+    # rows: (library, run, project, reads, align_rate)
+    conn.executemany("""INSERT INTO alignment VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (library, run) DO UPDATE SET project = excluded.project, reads = excluded.reads,
+        align_rate = excluded.align_rate""", rows)
+
+def upsert_assignment(conn, rows):
+    # rows: (library, run, project, total, assign_rate)
+    conn.executemany("""INSERT INTO assignment VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (library, run) DO UPDATE SET project = excluded.project, total = excluded.total,
+        assign_rate = excluded.assign_rate""", rows)
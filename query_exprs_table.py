@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+### ........ ABOUT ........###
+
+# Pull a few genes x libraries out of a joined expression table (join_exprs_table.py output)
+# without reading the whole table: rows are found through the table's .idx index (written by
+# join_exprs_table.py --mode native, or here on first use) and read through mmap.
+# Writes a tab-separated table, with a header row, to stdout or --out.
+
+# query_exprs_table.py -h
+
+#usage: query_exprs_table.py [-h] [--genes GENES] [--libraries LIBRARIES] [--header HEADER] [--out OUT] table
+
+#examples:
+#  query_exprs_table.py joined_TPM.tsv --genes ENSG00000141510,ENSG00000012048
+#  query_exprs_table.py joined_TPM.tsv --genes myGenes.txt --libraries 1001,1004 --out subset.tsv
+#  query_exprs_table.py output_TPM.tsv --header JMP_header.txt --genes ENSG00000141510   (join script output)
+
+### ........ IMPORT MODULES ........###
+
+import os
+import sys
+import argparse
+import exprs_index
+
+### ........ DEFINE FUNCTIONS ........###
+
+def id_list(text):
+    # IDs given on the command line: a file with one ID per line, or a comma-separated list
+    if os.path.isfile(text):
+        with open(text, 'r') as idFile:
+            return idFile.read().split()
+    return [i for i in text.split(',') if i]
+
+
+### ........ DEFINE COMMAND LINE ARGUMENTS & VARIABLES ........###
+
+parser = argparse.ArgumentParser(description='Pull selected genes x libraries out of a joined expression table through its index.')
+parser.add_argument('table', type=str,
+                    help='joined table (uncompressed), e.g. joined_TPM.tsv')
+parser.add_argument('--genes', type=str, default='',
+                    help='gene IDs to pull: a comma-separated list or a file with one per line (default: all genes, in table order)')
+parser.add_argument('--libraries', type=str, default='',
+                    help='library IDs to pull, in this order: a comma-separated list or a file with one per line (default: all libraries)')
+parser.add_argument('--header', type=str, default='',
+                    help='for a table with no header row (from a join script), its library IDs: JMP_header.txt, or a comma-separated list')
+parser.add_argument('--out', type=str, default='',
+                    help='file to write to (default: stdout)')
+args = parser.parse_args()
+
+
+### ........ CODE ........###
+
+# STEP 1) Load the index, indexing the table first if it has no index or has changed
+index = exprs_index.read_index(args.table)
+if index is None:
+    sys.stderr.write("Indexing " + args.table + "...\n")
+    exprs_index.write_index(args.table, id_list(args.header) if args.header else None)
+    index = exprs_index.read_index(args.table)
+tableLibs, offsets = index
+
+# STEP 2) Check the libraries asked for
+libIDs = id_list(args.libraries)
+missingLibs = [i for i in libIDs if i not in tableLibs]
+if missingLibs:
+    sys.stderr.write("ERROR: not in " + args.table + ": " + ", ".join(missingLibs) + "\n")
+    exit(1)
+
+# STEP 3) Pull the rows and write them out
+geneIDs = id_list(args.genes) if args.genes else sorted(offsets, key=offsets.get)
+rows, missingGenes = exprs_index.query_table(args.table, index, geneIDs, libIDs)
+for geneID in missingGenes:
+    sys.stderr.write("WARNING: " + geneID + " is not in " + args.table + "\n")
+outFile = open(args.out, 'w') if args.out else sys.stdout
+outFile.write('\t'.join(["GeneID"] + (libIDs or tableLibs)) + '\n')
+for row in rows:
+    outFile.write('\t'.join(row) + '\n')
+if args.out:
+    outFile.close()